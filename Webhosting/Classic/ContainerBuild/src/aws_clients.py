@@ -0,0 +1,49 @@
+# Copyright (c) 2020 Anthony Potappel - LINKIT, The Netherlands.
+# SPDX-License-Identifier: MIT
+
+"""
+Lazily created, memoised boto3 clients shared by the Lambdas in this
+directory. Clients (and boto3 itself) are only loaded when a code path uses
+them, so cold starts only pay for the services that are actually called.
+"""
+
+import json
+import threading
+
+
+# {(service_name, retries): client}
+_clients = {}
+# {service_name: client} -- takes precedence, e.g. stubs in a local harness
+_registered = {}
+_lock = threading.Lock()
+
+# adaptive retry mode backs off (client-side rate limiting) on throttling,
+# e.g. SlowDown or ThrottlingException -- for calls made in bulk
+ADAPTIVE = {'max_attempts': 10, 'mode': 'adaptive'}
+
+
+def register(service_name, instance):
+    """Serve instance for all client(service_name, ..) calls"""
+    _registered[service_name] = instance
+
+
+def client(service_name, retries=None):
+    """Return (memoised) boto3 client. Retries configures the botocore
+    retry behaviour, e.g. ADAPTIVE"""
+    if service_name in _registered:
+        return _registered[service_name]
+
+    key = (service_name, json.dumps(retries, sort_keys=True))
+    if key in _clients:
+        return _clients[key]
+
+    # client creation is not thread-safe, probes may run on a thread pool
+    with _lock:
+        if key not in _clients:
+            import boto3
+            kwargs = {}
+            if retries:
+                from botocore.config import Config
+                kwargs['config'] = Config(retries=retries)
+            _clients[key] = boto3.client(service_name, **kwargs)
+    return _clients[key]
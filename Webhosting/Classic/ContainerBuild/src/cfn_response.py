@@ -0,0 +1,160 @@
+# Copyright (c) 2020 Anthony Potappel - LINKIT, The Netherlands.
+# SPDX-License-Identifier: MIT
+
+"""
+Lightweight responses for custom resources and waiter probes, shared by the
+Lambdas in this directory. Only uses the default library (http.client) to
+keep imports cheap and builds free of (pip-)requirements. One keep-alive
+HTTPS connection per host is re-used across calls in warm containers.
+"""
+
+import json
+import time
+import uuid
+import logging
+import threading
+import http.client
+import urllib.parse
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+# transient errors (5xx, dropped connections) are retried until this deadline
+RETRY_DEADLINE_SECONDS = 20
+REQUEST_TIMEOUT_SECONDS = 10
+
+# {(scheme, host): connection}
+_connections = {}
+_lock = threading.Lock()
+
+
+def connection(scheme, host):
+    """Return (cached) keep-alive connection to host"""
+    if (scheme, host) not in _connections:
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, timeout=REQUEST_TIMEOUT_SECONDS)
+        else:
+            conn = http.client.HTTPConnection(host, timeout=REQUEST_TIMEOUT_SECONDS)
+        _connections[(scheme, host)] = conn
+    return _connections[(scheme, host)]
+
+
+def request(method, url, body, headers, deadline=RETRY_DEADLINE_SECONDS):
+    """Send body (bytes) to url, return the HTTP status code. Transient
+    errors are retried with exponential backoff until deadline (seconds)"""
+    parsed = urllib.parse.urlsplit(url)
+    path = parsed.path or '/'
+    if parsed.query:
+        path = f'{path}?{parsed.query}'
+
+    end_time = time.time() + deadline
+    attempt = 0
+    with _lock:
+        while True:
+            conn = connection(parsed.scheme, parsed.netloc)
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                # read to the end, else the connection can not be re-used
+                response.read()
+                if response.status < 500:
+                    return response.status
+                error = f'HTTP {response.status}'
+            except (http.client.HTTPException, OSError) as e:
+                # stale keep-alive or network error -- reconnect on retry
+                conn.close()
+                error = str(e)
+
+            attempt += 1
+            delay = min(0.1 * 2 ** attempt, 2)
+            if time.time() + delay > end_time:
+                raise ConnectionError(f'{method} failed after {attempt} attempts: {error}')
+            logger.info(f'{method} attempt {attempt} failed: {error}, retrying')
+            time.sleep(delay)
+
+
+def send(event, context, responseStatus, response_data, physicalResourceId=None, noEcho=False):
+    """Send custom resource response to the CloudFormation ResponseURL"""
+    response_body = json.dumps({
+        'Status' : responseStatus,
+        'Reason': f'See the details in CloudWatch Log Stream: {context.log_stream_name}',
+        'PhysicalResourceId': physicalResourceId or context.log_stream_name,
+        'StackId': event['StackId'],
+        'RequestId': event['RequestId'],
+        'LogicalResourceId': event['LogicalResourceId'],
+        'NoEcho': noEcho,
+        'Data': response_data
+    })
+    logger.info('Response body:\n' + response_body)
+
+    body = response_body.encode()
+    headers = {
+        'content-type': '',
+        'content-length': str(len(body))
+    }
+
+    try:
+        status_code = request('PUT', event['ResponseURL'], body, headers)
+        logger.info(f'Status code: {str(status_code)}')
+    except Exception as e:
+        logger.info(f'send(..) failed executing requests.put(..): {str(e)}')
+
+
+def send_status(event, context, response_status, response_data):
+    """Send status by writing back the response to an S3 PreSigned URL"""
+    try:
+        url = event['ResponseUrlData']['Url']
+        formdata = event['ResponseUrlData']['FormData']
+        request_id = event['RequestId']
+    except:
+        # not invoked from an eventrule_lambda
+        logger.info('send_status() skipped')
+        return
+
+    try:
+        # Encode formdata and data as multipart/form-data as per AWS spec for
+        # S3 PreSigned. Generate random string to pass as boundary
+        boundary = str(uuid.uuid4())
+
+        # Encode base formdata (fields)
+        content_items = [
+            item
+            for name, value in formdata.items()
+            for item in [
+                f'--{boundary}', f'Content-Disposition: form-data; name="{name}"', '', str(value)
+            ]
+        ]
+
+        # Append (encoded) response data, echo the Invocation (if given) so
+        # the waiter knows this probe answered
+        result = {
+            'ResponseStatus': response_status,
+            'ResponseData': response_data,
+            'RequestId': request_id
+        }
+        if 'Invocation' in event:
+            result['Invocation'] = event['Invocation']
+        content_items = content_items + [
+            f'--{boundary}',
+            'Content-Disposition: form-data; name="file";',
+            f'Content-Type: application/octet-stream',
+            '',
+            json.dumps(result),
+            f'--{boundary}--',
+            ''
+        ]
+
+        # Merge items to a single body, separated by '\r\n'
+        body = '\r\n'.join(content_items).encode()
+
+        headers = {
+            'Content-Type': f'multipart/form-data; boundary={boundary}',
+            'Content-Length': str(len(body)),
+        }
+
+        status_code = request('POST', url, body, headers)
+        logger.info(f'Status code: {str(status_code)}')
+
+    except Exception as e:
+        logger.info(f'send_status(..) failed: {str(e)}')
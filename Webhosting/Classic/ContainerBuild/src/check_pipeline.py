@@ -1,117 +1,237 @@
 # Copyright (c) 2020 Anthony Potappel - LINKIT, The Netherlands.
 # SPDX-License-Identifier: MIT
 
+import re
 import logging
 import json
-import uuid
-import boto3
-import urllib.request
+
+from cfn_response import send, send_status
+from aws_clients import client
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-client = boto3.client('codepipeline')
+# final execution states reported by (pushed) state-change events -- the
+# push eventrule is removed on any of these, a Superseded execution is left
+# to polling (which follows the latest execution)
+PIPELINE_FINAL_STATES = {
+    'SUCCEEDED': 'SUCCESS',
+    'FAILED': 'FAILED',
+    'STOPPED': 'FAILED',
+    'CANCELED': 'FAILED',
+    'SUPERSEDED': None
+}
+
+# (rule_name, request_id) of push registrations done by this container
+_push_registered = set()
+
+
+# execution statuses that end the wait of a tracked execution
+EXECUTION_FINAL_STATUSES = {
+    'Succeeded': 'SUCCESS',
+    'Failed': 'FAILED',
+    'Stopped': 'FAILED',
+    'Cancelled': 'FAILED'
+}
+
+
+def execution_status(payload):
+    """Return (status, execution_id, tracked) of the execution started by
+    PipelineUpdate, fall back on the latest execution if not known (or
+    Superseded by a newer execution)"""
+    pipeline_name = payload['PipelineName']
+    execution_id = payload.get('PipelineExecutionId', '')
+    if execution_id:
+        execution = client('codepipeline').get_pipeline_execution(
+            pipelineName=pipeline_name,
+            pipelineExecutionId=execution_id
+        )['pipelineExecution']
+        if execution['status'] != 'Superseded':
+            return execution['status'], execution_id, True
+
+    executions = client('codepipeline').list_pipeline_executions(
+        pipelineName=pipeline_name,
+        maxResults=1
+    )['pipelineExecutionSummaries']
+    if not executions:
+        return None, '', False
+    return executions[0]['status'], executions[0]['pipelineExecutionId'], False
+
+
+def stage_progress(pipeline_name, execution_id):
+    """Return {stageName: status} of stages run by the execution"""
+    stages = client('codepipeline').get_pipeline_state(name=pipeline_name)['stageStates']
+    return {
+        stage['stageName']: stage['latestExecution']['status']
+        for stage in stages
+        if stage.get('latestExecution', {}).get('pipelineExecutionId') == execution_id
+    }
 
 
 def resource_status(payload):
-    """Return SUCCESS if latest execution status of a Pipeline is 'Succeeded'"""
-    executions = client.list_pipeline_executions(
-        pipelineName=payload['PipelineName']
-    )['pipelineExecutionSummaries']
+    """Return SUCCESS if status of the (tracked or latest) execution of a
+    Pipeline is 'Succeeded', FAILED if the tracked execution did not succeed,
+    else IN_PROGRESS with per-stage progress"""
+    status, execution_id, tracked = execution_status(payload)
+    response = {
+        'Name': payload['PipelineName'],
+        'ExecutionId': execution_id
+    }
+
+    final_status = EXECUTION_FINAL_STATUSES.get(status)
+    if final_status == 'SUCCESS' or (final_status and tracked):
+        return dict(response, Status=final_status, ExecutionStatus=status)
+
+    if status in ['InProgress', 'Stopping']:
+        response['Stages'] = stage_progress(payload['PipelineName'], execution_id)
+    return dict(response, Status='IN_PROGRESS', ExecutionStatus=status or 'None')
+
+
+def is_event_driven(payload):
+    """Check if pipeline state-change events should be pushed"""
+    return str(payload.get('EventDriven', 'false')).lower() == 'true'
+
+
+def push_rule_name(pipeline_name):
+    """Name of the eventrule that pushes state-changes of a pipeline -- the
+    Lambda is only allowed to manage rule/<pipeline>-waiter (see template)"""
+    return re.sub('[^-._a-zA-Z0-9]', '-', f'{pipeline_name}-waiter')[0:64]
+
+
+def push_register(event, context):
+    """Route final execution state-change events of the pipeline to this
+    function. The rule target input carries the waiter (presigned) response
+    data, so a state-change writes its result without an extra probe round"""
+    pipeline_name = event['ResourceProperties']['PipelineName']
+    rule_name = push_rule_name(pipeline_name)
+    if (rule_name, event['RequestId']) in _push_registered:
+        return {}
+
+    client('events').put_rule(
+        Name=rule_name,
+        EventPattern=json.dumps({
+            'source': ['aws.codepipeline'],
+            'detail-type': ['CodePipeline Pipeline Execution State Change'],
+            'detail': {
+                'pipeline': [pipeline_name],
+                'state': list(PIPELINE_FINAL_STATES.keys())
+            }
+        }),
+        State='ENABLED',
+        Description=f'Push execution results of {pipeline_name} to waiter'
+    )
+
+    # <state> and <execution> are filled in from the state-change event
+    input_template = json.dumps({
+        'RequestType': 'PipelineStateChange',
+        'ResourceProperties': event['ResourceProperties'],
+        'ResponseUrlData': event['ResponseUrlData'],
+        'RequestId': event['RequestId'],
+        'State': '<state>',
+        'ExecutionId': '<execution>'
+    })
+    client('events').put_targets(
+        Rule=rule_name,
+        Targets=[
+            {
+                'Id': 'Self',
+                'Arn': context.invoked_function_arn,
+                'InputTransformer': {
+                    'InputPathsMap': {
+                        'state': '$.detail.state',
+                        'execution': '$.detail.execution-id'
+                    },
+                    'InputTemplate': input_template
+                }
+            }
+        ]
+    )
+    _push_registered.add((rule_name, event['RequestId']))
+    return {}
+
 
+def push_deregister(pipeline_name):
+    """Remove the state-change eventrule, if it exists"""
+    rule_name = push_rule_name(pipeline_name)
     try:
-        latest_execution_status = executions[0]['status']
-        if latest_execution_status == 'Succeeded':
-            return {'Status': 'SUCCESS', 'Name': payload['PipelineName']}
-    except:
+        client('events').remove_targets(Rule=rule_name, Ids=['Self'])
+        client('events').delete_rule(Name=rule_name)
+    except client('events').exceptions.ResourceNotFoundException:
         pass
-
+    for item in [item for item in _push_registered if item[0] == rule_name]:
+        _push_registered.discard(item)
     return {}
 
 
+def state_change(event):
+    """Translate a (pushed) pipeline state-change into (final, status,
+    response). Final is False for state-changes of other executions"""
+    state = event.get('State', '')
+    if state not in PIPELINE_FINAL_STATES:
+        return False, None, {}
+    execution_id = event['ResourceProperties'].get('PipelineExecutionId', '')
+    if execution_id and execution_id != event.get('ExecutionId', ''):
+        # state-change of another execution
+        return False, None, {}
+    status = PIPELINE_FINAL_STATES[state]
+    return True, status, {
+        'Status': status or state,
+        'Name': event['ResourceProperties']['PipelineName'],
+        'ExecutionId': event.get('ExecutionId', '')
+    }
+
+
+def resource(event, context):
+    """Custom resource that removes the push eventrule on Delete -- e.g. of a
+    stack deleted before the tracked execution ended"""
+    pipeline_name = event['ResourceProperties']['PipelineName']
+    if event['RequestType'] == 'Delete':
+        push_deregister(pipeline_name)
+    send(event, context, 'SUCCESS', {}, push_rule_name(pipeline_name))
+
+
 def handler(event, context):
     """Called by eventrule based Lambda"""
     try:
         request_type = event['RequestType']
         if request_type == 'StatusUpdate':
-            response = resource_status(event['ResourceProperties'])
-
-            # only send SUCCESS if response contains data
-            if response:
-                logger.info(json.dumps(
-                    {'ResponseStatus': 'SUCCESS', 'ResponseData': response}))
-                send_status(event, context, 'SUCCESS', response)
-            else:
-                logger.info(json.dumps(
-                    {'ResponseStatus': 'N/A', 'ResponseData': {}}))
+            payload = event['ResourceProperties']
+            response = resource_status(payload)
+            status = response['Status']
+
+            # IN_PROGRESS is informational (stage progress) to the waiter
+            logger.info(json.dumps(
+                {'ResponseStatus': status, 'ResponseData': response}))
+            send_status(event, context, status, response)
+            if status != 'IN_PROGRESS':
+                if is_event_driven(payload):
+                    push_deregister(payload['PipelineName'])
+            elif response['ExecutionId'] == payload.get('PipelineExecutionId', '') \
+                    or not payload.get('PipelineExecutionId'):
+                # not when Superseded, see PIPELINE_FINAL_STATES
+                if is_event_driven(payload) and event.get('ResponseUrlData'):
+                    # polling stays in place as a fallback
+                    try:
+                        push_register(event, context)
+                    except Exception as e:
+                        logger.info(f'push_register(..) failed: {str(e)}')
+        elif request_type == 'PipelineStateChange':
+            # pushed via the eventrule set by push_register
+            final, status, response = state_change(event)
+            logger.info(json.dumps(
+                {'ResponseStatus': status or 'N/A', 'ResponseData': response}))
+            if status:
+                send_status(event, context, status, response)
+            if final:
+                push_deregister(event['ResourceProperties']['PipelineName'])
+        elif request_type in ['Create', 'Update', 'Delete']:
+            # custom resource, see CheckPipelineRule
+            resource(event, context)
         else:
             raise ValueError(f'RequestType \'{request_type}\' invalid')
     except Exception as e:
         logger.info(f'Unexpected RuntimeError:{str(e)}')
-        send_status(event, context, 'FAILED', {'Message': str(e)})
-
-
-def send_status(event, context, response_status, response_data):
-    """Send status by writing back the response to an S3 PreSigned URL"""
-    try:
-        url = event['ResponseUrlData']['Url']
-        formdata = event['ResponseUrlData']['FormData']
-        request_id = event['RequestId']
-    except:
-        # not invoked from an eventrule_lambda
-        logger.info('send_status() skipped')
-        return
-
-    try:
-        """
-        Encode formdata and data as multipart/form-data as per AWS spec for S3 PreSigned.
-        While this is trivial in Python requests module, the request module is not
-        included in the default library set. Using urllib.request allows re-use of this
-        function without (pip-)build requirements, which is useful for simple custom resources.
-        """
-
-        # Generate random string to pass as boundary
-        boundary = str(uuid.uuid4())
-    
-        # Encode base formdata (fields)
-        flatten = lambda l: [item for sublist in l for item in sublist]
-        content_items = flatten([
-            [f'--{boundary}', f'Content-Disposition: form-data; name="{name}"', '', str(value)]
-            for name, value in formdata.items()
-        ])
-    
-        # Append (encoded) response data
-        content_items = content_items + [
-            f'--{boundary}',
-            'Content-Disposition: form-data; name="file";',
-            f'Content-Type: application/octet-stream',
-            '',
-            json.dumps({
-                'ResponseStatus': response_status,
-                'ResponseData': response_data,
-                'RequestId': request_id
-            }),
-            f'--{boundary}--',
-            ''
-        ]
-    
-        # Merge items to a single body, separated by '\r\n'
-        response_body = '\r\n'.join(content_items)
-
-        headers = {
-            'Content-Type': f'multipart/form-data; boundary={boundary}',
-            'Content-Length': str(len(response_body)),
-        }
-
-        req = urllib.request.Request(
-            url,
-            headers=headers,
-            data=response_body.encode(),
-            method='POST'
-        )
-
-        with urllib.request.urlopen(req) as response:
-            logger.info(f'Status code: {str(response.getcode())}')
-
-    except Exception as e:
-        logger.info(f'send_status(..) failed: {str(e)}')
+        if event.get('ResponseURL'):
+            send(event, context, 'FAILED', {'Message': str(e)})
+        else:
+            send_status(event, context, 'FAILED', {'Message': str(e)})
@@ -2,17 +2,22 @@
 # SPDX-License-Identifier: MIT
 
 import re
-import json
-import boto3
-import json
+import time
 import logging
-import urllib.request
+
+from cfn_response import send
+from aws_clients import ADAPTIVE, client
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
-ecr_client = boto3.client("ecr")
+# max concurrent create_repository|delete_repository calls
+ECR_WORKERS = 10
+
+# stop starting new calls when the Lambda timeout gets this close
+DEADLINE_MARGIN_SECONDS = 10
 
 
 def trim_alphanum(name, length=100):
@@ -25,25 +30,66 @@ def trim_alphanum(name, length=100):
 trim_alphanum_list = lambda l, s: [trim_alphanum(sub, length=s) for sub in l]
 
 
-def repository_exists():
-    """Check if ECR repository exists"""
-    """TODO: add pagination"""
-    response = ecr_client.describe_repositories(maxResults=500)
-    return [repo['repositoryName'] for repo in response['repositories']]
+def repository_exists(prefix=''):
+    """Return set of existing ECR repository names, limited to prefix"""
+    paginator = client('ecr', retries=ADAPTIVE).get_paginator('describe_repositories')
+    return {
+        repo['repositoryName']
+        for page in paginator.paginate(PaginationConfig={'PageSize': 1000})
+        for repo in page['repositories']
+        if repo['repositoryName'].startswith(prefix)
+    }
 
 
 def create_repository(name):
-    return ecr_client.create_repository(
-        repositoryName=name,
-        imageTagMutability='MUTABLE'
-    )
+    try:
+        return client('ecr', retries=ADAPTIVE).create_repository(
+            repositoryName=name,
+            imageTagMutability='MUTABLE'
+        )
+    except client('ecr', retries=ADAPTIVE).exceptions.RepositoryAlreadyExistsException:
+        # created in between lookup and create
+        return {}
 
 
 def delete_repository(name):
-    return ecr_client.delete_repository(
-        repositoryName=name,
-        force=True
-    )
+    try:
+        return client('ecr', retries=ADAPTIVE).delete_repository(
+            repositoryName=name,
+            force=True
+        )
+    except client('ecr', retries=ADAPTIVE).exceptions.RepositoryNotFoundException:
+        # deleted in between lookup and delete
+        return {}
+
+
+def repository_batch(function, names, deadline=None):
+    """Apply function (create|delete_repository) concurrently to names.
+    Calls not started before deadline (epoch) are skipped. Raise with
+    per-repository results if any call failed, completed calls are kept"""
+    def apply(name):
+        if deadline and time.time() > deadline:
+            return 'skipped, Lambda timeout nearing'
+        try:
+            function(name)
+        except Exception as e:
+            return str(e)
+        return ''
+
+    with ThreadPoolExecutor(max_workers=ECR_WORKERS) as executor:
+        results = dict(zip(names, executor.map(apply, names)))
+
+    for name, error in results.items():
+        logger.info(f'{function.__name__}:{name}:{error or "OK"}')
+
+    failed = [f'{name} ({error})' for name, error in results.items() if error]
+    if failed:
+        completed = [name for name, error in results.items() if not error]
+        raise Exception(''.join([
+            f'{function.__name__} failed: {", ".join(failed)}.',
+            f' Completed: {", ".join(completed) or "none"}.'
+        ]))
+    return names
 
 
 def update_repository_names(environment_name, repolist_str):
@@ -81,8 +127,8 @@ def update_repository_names(environment_name, repolist_str):
     return repolist
 
 
-def repository(request_type, payload):
-    """Create or Delete ECR repository"""
+def repository_config(payload):
+    """Return (environment_name, repolist) of a (validated) payload"""
     repolist_str = payload.get('RepositoryPathList', '')
     environment_name = payload.get('EnvironmentName', 'Dev')
     if environment_name != trim_alphanum(environment_name, length=127):
@@ -90,8 +136,49 @@ def repository(request_type, payload):
             'EnvironmentName must match [-A-Za-z0-9]',
             ', start with a letter, repeating hyphens not allowed'
         ]))
+    return environment_name, update_repository_names(environment_name, repolist_str)
+
+
+def repository_fullnames(environment_name, repolist):
+    """Return ECR repository names, prefixed by environment_name"""
+    return ['/'.join([environment_name, reponame]).lower() for reponame in repolist]
+
+
+def repository_reconcile(payload, old_payload, deadline=None):
+    """Update ECR repositories based on the difference between old and new
+    payload -- unchanged repositories are not looked up, Retain is honoured"""
+    environment_name, repolist = repository_config(payload)
+    ecr_create_list = repository_fullnames(environment_name, repolist)
+    old_fullnames = repository_fullnames(*repository_config(old_payload))
+
+    ecr_delete_list = []
+    if str(payload.get('Retain', 'false')).lower() != 'true':
+        ecr_delete_list = [
+            fullname for fullname in old_fullnames if fullname not in ecr_create_list
+        ]
+
+    # only the delta calls ECR, existing repositories are tolerated on create
+    repository_batch(
+        create_repository,
+        [fullname for fullname in ecr_create_list if fullname not in old_fullnames],
+        deadline=deadline
+    )
+    repository_batch(delete_repository, ecr_delete_list, deadline=deadline)
+
+    return {
+        'EnvironmentName': environment_name,
+        'RepositoryPathList': ','.join(repolist),
+        'EcrDelete': ','.join(ecr_delete_list),
+        'EcrCreate': ','.join(ecr_create_list)
+    }
 
-    repolist = update_repository_names(environment_name, repolist_str)
+
+def repository(request_type, payload, deadline=None, old_payload=None):
+    """Create or Delete ECR repository"""
+    if request_type == 'Update' and old_payload is not None:
+        return repository_reconcile(payload, old_payload, deadline=deadline)
+
+    environment_name, repolist = repository_config(payload)
 
     if not repolist:
         return {
@@ -115,20 +202,23 @@ def repository(request_type, payload):
         except:
             pass
 
-        exists = repository_exists()
+        exists = repository_exists(prefix=f'{environment_name.lower()}/')
 
-        for reponame in repolist:
-            fullname = '/'.join([environment_name, reponame]).lower()
-            if fullname in exists:
-                delete_repository(fullname)
-            ecr_delete_list.append(fullname)
+        ecr_delete_list = repository_fullnames(environment_name, repolist)
+        repository_batch(
+            delete_repository,
+            [fullname for fullname in ecr_delete_list if fullname in exists],
+            deadline=deadline
+        )
     else:
-        exists = repository_exists()
-        for reponame in repolist:
-            fullname = '/'.join([environment_name, reponame]).lower()
-            if fullname not in exists:
-                create_repository(fullname)
-            ecr_create_list.append(fullname)
+        exists = repository_exists(prefix=f'{environment_name.lower()}/')
+
+        ecr_create_list = repository_fullnames(environment_name, repolist)
+        repository_batch(
+            create_repository,
+            [fullname for fullname in ecr_create_list if fullname not in exists],
+            deadline=deadline
+        )
 
     return {
         'EnvironmentName': environment_name,
@@ -144,47 +234,19 @@ def handler(event, context):
         request_type = event['RequestType']
         if request_type not in ['Create', 'Update', 'Delete']:
             raise ValueError(f'RequestType invalid:{str(request_type)}')
+        deadline = \
+            time.time() \
+            + context.get_remaining_time_in_millis() / 1000 - DEADLINE_MARGIN_SECONDS
         send(event,
              context,
              'SUCCESS',
-             repository(request_type, event['ResourceProperties']),
+             repository(
+                 request_type,
+                 event['ResourceProperties'],
+                 deadline=deadline,
+                 old_payload=event.get('OldResourceProperties')
+             ),
              event['LogicalResourceId']
         )
     except Exception as e:
         send(event, context, 'FAILED', {'Message': str(e)})
-
-
-def send(event, context, responseStatus, response_data, physicalResourceId=None, noEcho=False):
-    responseUrl = event['ResponseURL']
-    logger.info(responseUrl)
-
-    response_body = {
-        'Status' : responseStatus,
-        'Reason': f'See the details in CloudWatch Log Stream: {context.log_stream_name}',
-        'PhysicalResourceId': physicalResourceId or context.log_stream_name,
-        'StackId': event['StackId'],
-        'RequestId': event['RequestId'],
-        'LogicalResourceId': event['LogicalResourceId'],
-        'NoEcho': noEcho,
-        'Data': response_data
-    }
-
-    json_responseBody = json.dumps(response_body)
-    logger.info('Response body:\n' + json_responseBody)
-
-    headers = {
-        'content-type': '',
-        'content-length': str(len(json_responseBody))
-    }
-
-    try:
-        req = urllib.request.Request(
-            responseUrl,
-            data=json_responseBody.encode(),
-            headers=headers,
-            method='PUT'
-        )
-        with urllib.request.urlopen(req) as response:
-            logger.info(f'Status code: {str(response.getcode())}')
-    except Exception as e:
-        logger.info(f'send(..) failed executing requests.put(..): {str(e)}')
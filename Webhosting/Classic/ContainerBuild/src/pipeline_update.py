@@ -3,19 +3,16 @@
 
 import re
 import json
+import hashlib
 import logging
-import copy
-import boto3
-import urllib.request
 
+from cfn_response import send
+from aws_clients import client
 from collections import defaultdict
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-client = boto3.client('codepipeline')
-
-
 """Convert nested list to single"""
 flatten_list = lambda l: [item for sublist in l for item in sublist]
 
@@ -37,56 +34,82 @@ def change_dictkeys(obj, function):
     return obj
 
 
+def canonical(obj):
+    """Drop empty (optional) values recursively, so that definitions that
+    only differ in omitted defaults compare equal"""
+    if isinstance(obj, list):
+        return [canonical(v) for v in obj]
+    if isinstance(obj, dict):
+        return {
+            k: canonical(v) for k, v in obj.items() if v not in [None, [], {}]
+        }
+    return obj
+
+
+def pipeline_hash(pipeline):
+    """Return sha256 of the canonical (json) form of a pipeline definition"""
+    return hashlib.sha256(
+        json.dumps(canonical(pipeline), sort_keys=True, separators=(',', ':')).encode()
+    ).hexdigest()
+
+
 def mapper(template, config):
-    """Map template to list based on (env-)config"""
+    """Map template to list based on (env-)config. Mapped actions share the
+    unchanged parts of template, only name, configuration and
+    outputArtifacts are composed per action"""
     # boto3 spec updates; dictkey rule exception and runOrder type
-    template['configuration'] = \
+    configuration = \
         change_dictkeys(template['configuration'], lambda k: k[:1].upper() + k[1:])
-    template['runOrder'] = int(template.get('runOrder', 1))
- 
+    template = dict(
+        template, configuration=configuration, runOrder=int(template.get('runOrder', 1)))
+
     if template['name'] not in config:
-        actions = [template]
-    else:
-        # map parameter sets
-        _map = defaultdict(list)
-        for key, vlist in config[template['name']]['EnvironmentVariables'].items():
-            for y, val in enumerate(vlist.split(',')):
-                _map[y].append({'name': key, 'value': val, 'type': 'PLAINTEXT'})
-   
-        # append existing (global) env vars if set
-        # codebuild EnvironmentVariables keys ['name', 'value', 'type'] must be lowercase
-        envvars = \
-            change_dictkeys(
-                template['configuration'].get('EnvironmentVariables', '[]'),
-                lambda k: k[:1].lower() + k[1:]
-            )
-        logger.info( envvars )
-        if envvars:
-            _map = {k: v + envvars for k, v in _map.items()}
-
-        # create action-list -- name and Environment are unique per action
-        actions = [copy.deepcopy(template) for _ in _map.keys()]
-
-        # name input is expected to be a comma separated list
-        # trim and replace charts to meet codepipeline action name spec
-        namelist = [
-            trim_alphanum(name)
-            for name in config[template['name']]['NameList'].split(',')
-        ]
-        logger.info( str( namelist ) )
-
-        for idx, varstr in enumerate([
-            json.dumps(v, separators=(',', ':')) for _, v in sorted(_map.items())
-        ]):
-            actions[idx]['name'] = namelist[idx]
-            actions[idx]['configuration']['EnvironmentVariables'] = varstr
-            # output artifact names must be unique -- update accordingly
-            output_list = actions[idx].get('outputArtifacts')
-            if output_list:
-                actions[idx]['outputArtifacts'] = [
-                    {'name': trim_alphanum(f"{output['name']}-{namelist[idx]}")}
-                    for output in output_list
-                ]
+        return [template]
+
+    # map parameter sets
+    _map = defaultdict(list)
+    for key, vlist in config[template['name']]['EnvironmentVariables'].items():
+        for y, val in enumerate(vlist.split(',')):
+            _map[y].append({'name': key, 'value': val, 'type': 'PLAINTEXT'})
+
+    # append existing (global) env vars if set -- serialised once
+    # codebuild EnvironmentVariables keys ['name', 'value', 'type'] must be lowercase
+    envvars = configuration.get('EnvironmentVariables') or []
+    if isinstance(envvars, str):
+        # as returned by get_pipeline
+        envvars = json.loads(envvars)
+    envvars = change_dictkeys(envvars, lambda k: k[:1].lower() + k[1:])
+    logger.info( envvars )
+    envvars_suffix = ''
+    if envvars:
+        envvars_suffix = ',' + json.dumps(envvars, separators=(',', ':'))[1:-1]
+
+    # name input is expected to be a comma separated list
+    # trim and replace charts to meet codepipeline action name spec
+    namelist = [
+        trim_alphanum(name)
+        for name in config[template['name']]['NameList'].split(',')
+    ]
+    logger.info( str( namelist ) )
+
+    # name and Environment are unique per action
+    output_list = template.get('outputArtifacts')
+    actions = []
+    for idx, (_, variables) in enumerate(sorted(_map.items())):
+        varstr = \
+            '[' + json.dumps(variables, separators=(',', ':'))[1:-1] + envvars_suffix + ']'
+        action = dict(
+            template,
+            name=namelist[idx],
+            configuration=dict(configuration, EnvironmentVariables=varstr)
+        )
+        # output artifact names must be unique -- update accordingly
+        if output_list:
+            action['outputArtifacts'] = [
+                {'name': trim_alphanum(f"{output['name']}-{namelist[idx]}")}
+                for output in output_list
+            ]
+        actions.append(action)
     return actions
 
 
@@ -125,7 +148,8 @@ def main(event):
             {'order': int(stage['StageOrder']), 'spec': spec}
   
     # existing Pipeline
-    pipeline = client.get_pipeline(name=payload['Target'])['pipeline']
+    pipeline = client('codepipeline').get_pipeline(name=payload['Target'])['pipeline']
+    current_hash = pipeline_hash(pipeline)
     # insert existing stages not included in update
     pipeline['stages'] = \
         [stage for stage in pipeline['stages'] if stage['name'] not in stages_new.keys()]
@@ -133,24 +157,34 @@ def main(event):
     for stage in sorted(stages_new.values(), key = lambda item: item["order"]):
         pipeline['stages'].insert(stage['order'], stage['spec'])
 
-    response = client.update_pipeline(pipeline=pipeline)
-    logger.info(json.dumps(response))
+    # no-op (stack) updates leave the pipeline as is and are not executed
+    changed = request == 'Create' or pipeline_hash(pipeline) != current_hash
+    if changed:
+        response = client('codepipeline').update_pipeline(pipeline=pipeline)
+        logger.info(json.dumps(response))
+    else:
+        logger.info(f"Pipeline {pipeline['name']} unchanged, update skipped")
 
     # possibly remove DisableInboundStageTransitions
     if payload.get('EnableInboundStageTransitions', []):
         for stage_name in payload['EnableInboundStageTransitions']:
-            client.enable_stage_transition(
-                pipelineName=response['pipeline']['name'],
+            client('codepipeline').enable_stage_transition(
+                pipelineName=pipeline['name'],
                 stageName=stage_name,
                 transitionType='Inbound'
             )
 
-    if payload.get('ExecutePipeline', '').lower() == 'true':
-        client.start_pipeline_execution(name=response['pipeline']['name'])
+    # execution id allows probes to track this specific execution
+    execution_id = ''
+    if changed and payload.get('ExecutePipeline', '').lower() == 'true':
+        execution_id = client('codepipeline').start_pipeline_execution(
+            name=pipeline['name'])['pipelineExecutionId']
 
     return {
         'RequestTypeCreate': int(request == 'Create'),
-        'PipelineName': response['pipeline']['name'],
+        'PipelineName': pipeline['name'],
+        'PipelineExecutionId': execution_id,
+        'PipelineChanged': int(changed),
         'Status': 'SUCCESS'
     }
 
@@ -165,39 +199,3 @@ def handler(event, context):
         )
     except Exception as e:
         send(event, context, 'FAILED', {'Message': str(e)})
-
-
-def send(event, context, responseStatus, response_data, physicalResourceId=None, noEcho=False):
-    responseUrl = event['ResponseURL']
-    logger.info(responseUrl)
-
-    response_body = {
-        'Status' : responseStatus,
-        'Reason': f'See the details in CloudWatch Log Stream: {context.log_stream_name}',
-        'PhysicalResourceId': physicalResourceId or context.log_stream_name,
-        'StackId': event['StackId'],
-        'RequestId': event['RequestId'],
-        'LogicalResourceId': event['LogicalResourceId'],
-        'NoEcho': noEcho,
-        'Data': response_data
-    }
-
-    json_responseBody = json.dumps(response_body)
-    logger.info('Response body:\n' + json_responseBody)
-
-    headers = {
-        'content-type': '',
-        'content-length': str(len(json_responseBody))
-    }
-
-    try:
-        req = urllib.request.Request(
-            responseUrl,
-            data=json_responseBody.encode(),
-            headers=headers,
-            method='PUT'
-        )
-        with urllib.request.urlopen(req) as response:
-            logger.info(f'Status code: {str(response.getcode())}')
-    except Exception as e:
-        logger.info(f'send(..) failed executing requests.put(..): {str(e)}')
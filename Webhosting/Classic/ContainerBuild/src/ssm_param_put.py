@@ -3,18 +3,27 @@
 
 
 import logging
-import json
-import boto3
-import urllib.request
+
+from cfn_response import send
+from aws_clients import ADAPTIVE, client
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-ssm_client = boto3.client('ssm')
+# max concurrent put_parameter calls, SSM (standard) throughput is low
+SSM_WORKERS = 3
+
+# max number of names per get_parameters call
+SSM_BATCH_SIZE = 10
+
+
+"""Split list in chunks of size"""
+chunks = lambda l, size: [l[idx:idx + size] for idx in range(0, len(l), size)]
 
 
 def ssm_update_parameter(name, value, tags=[]):
-    ssm_client.put_parameter(
+    client('ssm', retries=ADAPTIVE).put_parameter(
         Name=name,
         Value=value,
         Type='String',
@@ -25,34 +34,73 @@ def ssm_update_parameter(name, value, tags=[]):
     return {'ParameterName': name}
 
 
-def parameter_exists(name):
-    """Check if Parameter exists"""
-    response = ssm_client.describe_parameters(
-        Filters=[
-            {'Key': 'Type', 'Values': ['String']},
-            {'Key': 'Name', 'Values': [name]}
-        ]
-    )
-
-    if response.get('Parameters', []):
-        return True
-
-    # no match
-    return False
-
-
-def create_parameter(payload, request):
-    """Create new SSM Parameter if not yet exists"""
-    return ssm_update_parameter(payload['ParameterName'], payload['ParameterValue'])
+def parameter_map(payload):
+    """Return {name: value} of Parameters (map) and ParameterName/-Value"""
+    parameters = dict(payload.get('Parameters', {}))
+    if payload.get('ParameterName'):
+        parameters[payload['ParameterName']] = payload['ParameterValue']
+    return parameters
+
+
+def parameters_current(names):
+    """Return {name: value} of existing parameters, read in batches"""
+    current = {}
+    for batch in chunks(list(names), SSM_BATCH_SIZE):
+        response = client('ssm', retries=ADAPTIVE).get_parameters(Names=batch)
+        current.update({
+            parameter['Name']: parameter['Value']
+            for parameter in response.get('Parameters', [])
+        })
+    return current
+
+
+def parameters_exist(names):
+    """Return set of names that exist as parameter, checked in batches"""
+    return set(parameters_current(names).keys())
+
+
+def parameters_delete(names):
+    """Delete parameters in batches -- names that do not exist (anymore)
+    are reported as InvalidParameters, which counts as deleted"""
+    deleted = []
+    for batch in chunks(list(names), SSM_BATCH_SIZE):
+        response = client('ssm', retries=ADAPTIVE).delete_parameters(Names=batch)
+        deleted += response.get('DeletedParameters', [])
+        if response.get('InvalidParameters'):
+            logger.info(f"Parameters not found: {str(response['InvalidParameters'])}")
+    return deleted
+
+
+def create_parameter(payload, request, old_payload=None):
+    """Create or Update SSM Parameters -- only write values that differ"""
+    parameters = parameter_map(payload)
+    current = parameters_current(parameters.keys())
+
+    changed = [
+        name for name, value in parameters.items() if current.get(name) != value
+    ]
+    with ThreadPoolExecutor(max_workers=SSM_WORKERS) as executor:
+        list(executor.map(
+            lambda name: ssm_update_parameter(name, parameters[name]), changed))
+    logger.info(f'Parameters written: {str(changed)}')
+
+    # parameters removed from the payload on Update
+    if request == 'Update' and old_payload:
+        parameters_delete([
+            name for name in parameter_map(old_payload).keys() if name not in parameters
+        ])
+
+    if payload.get('ParameterName') and not payload.get('Parameters'):
+        return {'ParameterName': payload['ParameterName']}
+    return {
+        'ParameterNames': ','.join(sorted(parameters.keys())),
+        'ParametersWritten': ','.join(changed)
+    }
 
 
 def delete_parameter(payload):
-    """Remove SSM Parameter"""
-    if parameter_exists(payload['ParameterName']) is False:
-        # nothing needs to be done
-        return {}
-
-    ssm_client.delete_parameter(Name=payload['ParameterName'])
+    """Remove SSM Parameter(s) -- idempotent, no existence check needed"""
+    parameters_delete(parameter_map(payload).keys())
     return {}
 
 
@@ -72,44 +120,12 @@ def handler(event, context):
                 event,
                 context,
                 'SUCCESS',
-                create_parameter(event['ResourceProperties'], event['RequestType']),
+                create_parameter(
+                    event['ResourceProperties'],
+                    event['RequestType'],
+                    old_payload=event.get('OldResourceProperties')
+                ),
                 event['LogicalResourceId']
             )
     except Exception as e:
         send(event, context, 'FAILED', {'Message': str(e)})
-
-
-def send(event, context, responseStatus, response_data, physicalResourceId=None, noEcho=False):
-    responseUrl = event['ResponseURL']
-    logger.info(responseUrl)
-
-    response_body = {
-        'Status' : responseStatus,
-        'Reason': f'See the details in CloudWatch Log Stream: {context.log_stream_name}',
-        'PhysicalResourceId': physicalResourceId or context.log_stream_name,
-        'StackId': event['StackId'],
-        'RequestId': event['RequestId'],
-        'LogicalResourceId': event['LogicalResourceId'],
-        'NoEcho': noEcho,
-        'Data': response_data
-    }
-
-    json_responseBody = json.dumps(response_body)
-    logger.info('Response body:\n' + json_responseBody)
-
-    headers = {
-        'content-type': '',
-        'content-length': str(len(json_responseBody))
-    }
-
-    try:
-        req = urllib.request.Request(
-            responseUrl,
-            data=json_responseBody.encode(),
-            headers=headers,
-            method='PUT'
-        )
-        with urllib.request.urlopen(req) as response:
-            logger.info(f'Status code: {str(response.getcode())}')
-    except Exception as e:
-        logger.info(f'send(..) failed executing requests.put(..): {str(e)}')
@@ -2,72 +2,243 @@
 # SPDX-License-Identifier: MIT
 
 import json
-import boto3
+import time
 import logging
-import urllib.request
+
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+from cfn_response import send
+from aws_clients import ADAPTIVE, client
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
-s3 = boto3.resource('s3')
+# delete_objects accepts at most 1000 keys per call
+DELETE_BATCH_SIZE = 1000
+
+# shards are listed in parallel, each feeding batches to the delete workers
+SHARD_WORKERS = 4
+DELETE_WORKERS = 16
+
+# above this number of top-level prefixes, list the bucket as a single shard
+# (keeps the continuation well below the async invoke payload limit)
+SHARD_LIMIT = 64
+
+# stop listing this close to the Lambda timeout, finish in-flight deletes
+# and continue in a new invocation
+TIME_MARGIN_SECONDS = 15
+
+# above this (estimated) number of object versions, a lifecycle configuration
+# expires all objects as well -- keeps emptying the bucket should deletes not
+# complete within the hour CloudFormation waits for a response
+LIFECYCLE_THRESHOLD = 1000000
+
+_shard_executor = None
+_delete_executor = None
+
+
+def shard_executor():
+    """Shared (warm container) thread pool for shard listings"""
+    global _shard_executor
+    if _shard_executor is None:
+        _shard_executor = ThreadPoolExecutor(max_workers=SHARD_WORKERS)
+    return _shard_executor
+
+
+def delete_executor():
+    """Shared (warm container) thread pool for delete_objects calls"""
+    global _delete_executor
+    if _delete_executor is None:
+        _delete_executor = ThreadPoolExecutor(max_workers=DELETE_WORKERS)
+    return _delete_executor
 
 
-def empty_s3(payload):
-    """Empty all files in Bucket"""
-    bucket = s3.Bucket(payload['BucketName'])
-    bucket.object_versions.all().delete()
-    return {}
+def prefix_shards(bucket_name):
+    """Split bucket in key-prefix shards (top-level 'directories') that are
+    listed independently. Keys in the root of the bucket form a shard too.
+    Taken from a single listing page -- if that does not cover all top-level
+    prefixes (e.g. a flat bucket), or there are more than SHARD_LIMIT, the
+    bucket is listed as a single shard"""
+    page = client('s3', retries=ADAPTIVE).list_object_versions(
+        Bucket=bucket_name, Delimiter='/', MaxKeys=DELETE_BATCH_SIZE
+    )
+    prefixes = [item['Prefix'] for item in page.get('CommonPrefixes', [])]
+    if page.get('IsTruncated') or len(prefixes) > SHARD_LIMIT:
+        return [{'Prefix': ''}]
+    return [{'Prefix': '', 'Delimiter': '/'}] + [{'Prefix': prefix} for prefix in prefixes]
+
+
+def delete_batch(bucket_name, objects):
+    """Delete (up to DELETE_BATCH_SIZE) object versions, return count"""
+    response = client('s3', retries=ADAPTIVE).delete_objects(
+        Bucket=bucket_name,
+        Delete={'Objects': objects, 'Quiet': True}
+    )
+    errors = response.get('Errors', [])
+    if errors:
+        raise RuntimeError(f'Failed to delete {len(errors)} objects, e.g.: {errors[0]}')
+    return len(objects)
+
+
+def shard_empty(bucket_name, shard, deadline):
+    """List and delete all object versions and delete markers in shard.
+    Deletes run on the delete executor while listing continues. Returns
+    (deleted, shard), shard holds the markers to continue from, or is None
+    when the shard is empty"""
+    futures = []
+    while time.time() < deadline:
+        page = client('s3', retries=ADAPTIVE).list_object_versions(
+            Bucket=bucket_name, MaxKeys=DELETE_BATCH_SIZE, **shard
+        )
+        objects = [
+            {'Key': item['Key'], 'VersionId': item['VersionId']}
+            for item in page.get('Versions', []) + page.get('DeleteMarkers', [])
+        ]
+        if objects:
+            futures.append(delete_executor().submit(delete_batch, bucket_name, objects))
+
+        if not page.get('IsTruncated'):
+            shard = None
+            break
+        shard = {
+            **shard,
+            'KeyMarker': page['NextKeyMarker'],
+            'VersionIdMarker': page['NextVersionIdMarker']
+        }
+
+        # do not list further ahead than the delete workers can keep up with
+        if len(futures) > DELETE_WORKERS:
+            futures[-DELETE_WORKERS - 1].result()
+
+    return sum(future.result() for future in futures), shard
+
+
+def empty_s3(bucket_name, state, deadline):
+    """Empty bucket until done or deadline, continue from state (if any).
+    Returns the updated state, no Shards left means the bucket is empty"""
+    if 'Shards' in state:
+        shards = state['Shards']
+    else:
+        shards = prefix_shards(bucket_name)
+
+    results = list(shard_executor().map(
+        lambda shard: shard_empty(bucket_name, shard, deadline), shards
+    ))
+    return {
+        'Shards': [shard for _, shard in results if shard],
+        'Deleted': state.get('Deleted', 0) + sum(deleted for deleted, _ in results),
+        'Invocations': state.get('Invocations', 0) + 1
+    }
+
+
+def objects_estimate(bucket_name):
+    """Cheap estimate of the number of object versions in bucket: exact if
+    it fits a single listing page, else the most recent (daily) datapoint of
+    the NumberOfObjects storage metric -- but at least one page"""
+    page = client('s3', retries=ADAPTIVE).list_object_versions(
+        Bucket=bucket_name, MaxKeys=DELETE_BATCH_SIZE
+    )
+    count = len(page.get('Versions', [])) + len(page.get('DeleteMarkers', []))
+    if not page.get('IsTruncated'):
+        return count
+
+    end_time = datetime.now(timezone.utc)
+    datapoints = client('cloudwatch').get_metric_statistics(
+        Namespace='AWS/S3',
+        MetricName='NumberOfObjects',
+        Dimensions=[
+            {'Name': 'BucketName', 'Value': bucket_name},
+            {'Name': 'StorageType', 'Value': 'AllStorageTypes'}
+        ],
+        StartTime=end_time - timedelta(days=2),
+        EndTime=end_time,
+        Period=86400,
+        Statistics=['Average']
+    )['Datapoints']
+    if not datapoints:
+        return count
+    latest = max(datapoints, key=lambda point: point['Timestamp'])
+    return max(count, int(latest['Average']))
+
+
+def lifecycle_preferred(payload):
+    """Check if bucket is (also) to be emptied by a lifecycle configuration,
+    falls back to direct deletes only if the estimate fails"""
+    try:
+        estimate = objects_estimate(payload['BucketName'])
+    except Exception as e:
+        logger.warning(f'Skipping lifecycle expiry, no object estimate: {str(e)}')
+        return False
+    threshold = int(payload.get('LifecycleThreshold', LIFECYCLE_THRESHOLD))
+    logger.info(f'Estimated {estimate} object versions, lifecycle threshold: {threshold}')
+    return estimate >= threshold
+
+
+def lifecycle_expire(bucket_name):
+    """Replace lifecycle configuration by rules that expire all current and
+    noncurrent versions, expired delete markers and incomplete uploads"""
+    client('s3', retries=ADAPTIVE).put_bucket_lifecycle_configuration(
+        Bucket=bucket_name,
+        LifecycleConfiguration={
+            'Rules': [
+                {
+                    'ID': 'EmptyBucket',
+                    'Filter': {'Prefix': ''},
+                    'Status': 'Enabled',
+                    'Expiration': {'Days': 1},
+                    'NoncurrentVersionExpiration': {'NoncurrentDays': 1},
+                    'AbortIncompleteMultipartUpload': {'DaysAfterInitiation': 1}
+                },
+                {
+                    # can not be combined with Days in a single rule
+                    'ID': 'EmptyBucketDeleteMarkers',
+                    'Filter': {'Prefix': ''},
+                    'Status': 'Enabled',
+                    'Expiration': {'ExpiredObjectDeleteMarker': True}
+                }
+            ]
+        }
+    )
+
+
+def continue_async(event, context, state):
+    """Re-invoke this function to continue where this invocation stopped"""
+    client('lambda').invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType='Event',
+        Payload=json.dumps({**event, 'Continuation': state})
+    )
 
 
 def handler(event, context):
     """Called by Lambda -- only act on Delete"""
     try:
         if event['RequestType'] in ['Delete']:
-            send_cfnresponse(
-                event, context, 'SUCCESS', empty_s3(event['ResourceProperties'])
+            if 'Continuation' not in event \
+                    and lifecycle_preferred(event['ResourceProperties']):
+                # deletes continue below, expiry covers a (retried) stack
+                # delete that outlives the CloudFormation response timeout
+                lifecycle_expire(event['ResourceProperties']['BucketName'])
+            deadline = time.time() \
+                + context.get_remaining_time_in_millis() / 1000 - TIME_MARGIN_SECONDS
+            state = empty_s3(
+                event['ResourceProperties']['BucketName'],
+                event.get('Continuation', {}),
+                deadline
+            )
+            logger.info(
+                f"Invocation {state['Invocations']}: deleted {state['Deleted']} "
+                f"object versions, {len(state['Shards'])} shards remaining"
             )
+            if state['Shards']:
+                continue_async(event, context, state)
+                return
+            send(event, context, 'SUCCESS', {'Deleted': state['Deleted']})
         else:
-            send_cfnresponse(
+            send(
                 event, context, 'SUCCESS', {}, event['LogicalResourceId']
             )
     except Exception as e:
-        send_cfnresponse(event, context, 'FAILED', {'Message': str(e)})
-
-
-def send_cfnresponse(
-        event, context, responseStatus, response_data,
-        physicalResourceId=None, noEcho=False
-    ):
-    responseUrl = event['ResponseURL']
-
-    response_body = {
-        'Status' : responseStatus,
-        'Reason': f'See the details in CloudWatch Log Stream: {context.log_stream_name}',
-        'PhysicalResourceId': physicalResourceId or context.log_stream_name,
-        'StackId': event['StackId'],
-        'RequestId': event['RequestId'],
-        'LogicalResourceId': event['LogicalResourceId'],
-        'NoEcho': noEcho,
-        'Data': response_data
-    }
-
-    json_responseBody = json.dumps(response_body)
-    logger.info('Response body:\n' + json_responseBody)
-
-    headers = {
-        'content-type': '',
-        'content-length': str(len(json_responseBody))
-    }
-
-    try:
-        req = urllib.request.Request(
-            responseUrl,
-            data=json_responseBody.encode(),
-            headers=headers,
-            method='PUT'
-        )
-        with urllib.request.urlopen(req) as response:
-            logger.info(f'Status code: {str(response.getcode())}')
-    except Exception as e:
-        logger.info(f'send(..) failed executing requests.put(..): {str(e)}')
+        send(event, context, 'FAILED', {'Message': str(e)})
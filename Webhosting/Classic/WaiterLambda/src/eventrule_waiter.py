@@ -4,11 +4,21 @@
 import os
 import re
 import json
-import boto3
+import time
+import uuid
+import socket
+import random
 import logging
 import datetime
+import http.client
+import urllib.error
+import urllib.parse
 import urllib.request
 
+from cfn_response import send
+from aws_clients import ADAPTIVE, client
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
 from datetime import datetime  
 from datetime import timedelta
 from datetime import timezone
@@ -17,12 +27,38 @@ from datetime import timezone
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-s3_client = boto3.client('s3')
-events_client = boto3.client('events')
-lambda_client = boto3.client('lambda')
+TIMEOUT_MINUTES = 120
 
+# sub-minute polling stops when the remaining invocation time gets below
+# the next pause plus this margin -- leaves room for a final check and send
+POLL_MARGIN_SECONDS = 10
 
-TIMEOUT_MINUTES = 120
+# probe results are read, and probes invoked, concurrently on a shared pool
+PROBE_WORKERS = 8
+PROBE_TIMEOUT_SECONDS = 10
+
+_probe_executor = None
+
+# {bucket_key: (etag, contents)} of fetched items, kept in warm containers
+_fetch_cache = {}
+
+# presigned POST data is re-used until this close to its expiry
+PRESIGNED_MARGIN_SECONDS = 300
+
+# probe providers run by the waiter itself, results are not written to S3
+NATIVE_PROVIDERS = ['Http', 'Tcp']
+
+# Ecs probes of a wait are checked together, grouped per cluster in
+# describe_services calls of (at most) this many services
+ECS_BATCH_SIZE = 10
+
+# a Lambda probe that was invoked, but did not write a (new) result yet, is
+# not invoked again within this window -- see probe_in_flight
+PROBE_GRACE_SECONDS = 60
+
+# {bucket_name: region} and {bucket_key: presigned POST data}
+_region_cache = {}
+_presigned_cache = {}
 
 
 def trim_alphanum(name, length=None):
@@ -55,28 +91,251 @@ def compose_resource_name(stack_id, resource_id, length=128):
     return name
 
 
+def waiter_bucket():
+    """Name of the bucket that stores probe results and wait records"""
+    return re.sub('.*:', '', os.environ['S3BucketArn'])
+
+
+def waiter_key(name, item):
+    """Bucket key of an item (probe result, wait record) of a waiter"""
+    return '/'.join([os.environ['S3BucketPrefix'], name, item])
+
+
+def is_multiplex(payload):
+    """Check if waiter is driven by the shared (multiplex) eventrule"""
+    return str(payload.get('Multiplex', 'false')).lower() == 'true'
+
+
 def presigned_post_url(bucket, key, expires_in=TIMEOUT_MINUTES*60):
     """Url data given to probe functions to signal SUCCESS OR FAILURE"""
     response = \
-        s3_client.generate_presigned_post(bucket, key, ExpiresIn=expires_in)
+        client('s3').generate_presigned_post(bucket, key, ExpiresIn=expires_in)
     return {'Url': response['url'], 'FormData': response['fields']}
 
 
+def bucket_region_get(bucket_name):
+    """Region of the bucket -- fetched once per (warm) container"""
+    if bucket_name not in _region_cache:
+        _region_cache[bucket_name] = \
+            client('s3').get_bucket_location(Bucket=bucket_name)['LocationConstraint'] \
+            or 'us-east-1'
+    return _region_cache[bucket_name]
+
+
+def presigned_data(bucket_name, bucket_key, bucket_region, stored=None):
+    """Return presigned POST data for bucket_key, re-use stored (target
+    Input) or cached data until it is close to expiry"""
+    renew_time = \
+        datetime.now(timezone.utc) + timedelta(seconds=PRESIGNED_MARGIN_SECONDS)
+    for data in [stored, _presigned_cache.get(bucket_key)]:
+        if data and datetime.fromisoformat(data['Expires']) > renew_time:
+            return data
+
+    expires_in = TIMEOUT_MINUTES*60
+    data = presigned_post_url(bucket_name, bucket_key, expires_in=expires_in)
+    # overwrite URL with the Regional version to prevent 307 redirects
+    data['Url'] = f"https://{bucket_name}.s3.{bucket_region}.amazonaws.com/"
+    data['Expires'] = \
+        (datetime.now(timezone.utc) + timedelta(seconds=expires_in)).isoformat()
+    _presigned_cache[bucket_key] = data
+    return data
+
+
+def lambda_probe_items(probes):
+    """Return {item: properties} of Lambda probes"""
+    return {
+        f'lambda-probe-{str(idx)}': probe['Properties']
+        for idx, probe in enumerate(probes) if probe['Provider'] == 'Lambda'
+    }
+
+
+def native_probe_items(probes):
+    """Return {item: probe} of probes run by the waiter (Http, Tcp)"""
+    return {
+        f"{probe['Provider'].lower()}-probe-{str(idx)}": probe
+        for idx, probe in enumerate(probes) if probe['Provider'] in NATIVE_PROVIDERS
+    }
+
+
+def status_matches(status, codes):
+    """Check status against codes, e.g. '200', '200,204' or '200-399'"""
+    for code in str(codes).split(','):
+        low, _, high = code.strip().partition('-')
+        if int(low) <= status <= int(high or low):
+            return True
+    return False
+
+
+def http_probe(properties, timeout):
+    """SUCCESS if Url responds with a status in SuccessCodes"""
+    request = urllib.request.Request(
+        properties['Url'], method=properties.get('Method', 'GET'))
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    if status_matches(status, properties.get('SuccessCodes', '200-399')):
+        return 'SUCCESS', f'HTTP {status}'
+    return None, f'HTTP {status}'
+
+
+def tcp_probe(properties, timeout):
+    """SUCCESS if a connection to Host:Port is accepted"""
+    with socket.create_connection((properties['Host'], int(properties['Port'])), timeout):
+        return 'SUCCESS', f"connected to {properties['Host']}:{properties['Port']}"
+
+
+def native_probe(probe, timeout):
+    """Run an Http or Tcp probe, return (status, detail). Status is None
+    while the target is not (yet) ready -- which keeps the wait going"""
+    properties = probe.get('Properties', {})
+    timeout = float(properties.get('TimeoutInSeconds', timeout))
+    try:
+        if probe['Provider'] == 'Http':
+            return http_probe(properties, timeout)
+        return tcp_probe(properties, timeout)
+    except (OSError, http.client.HTTPException) as e:
+        # includes connection errors, timeouts and URLError, and a port that
+        # accepts connections but does not (yet) serve HTTP
+        return None, str(e)
+
+
+def native_probe_validate(probe):
+    """Raise ValueError on an invalid Http or Tcp probe -- checked once on
+    Create/Update, a probe that can never succeed fails the wait right away"""
+    properties = probe.get('Properties', {})
+    try:
+        float(properties.get('TimeoutInSeconds', PROBE_TIMEOUT_SECONDS))
+        if probe['Provider'] == 'Http':
+            url = urllib.parse.urlsplit(properties['Url'])
+            if url.scheme not in ['http', 'https'] or not url.hostname:
+                raise ValueError(f"Url {properties['Url']} is not an http(s) url")
+            # raises ValueError on a port out of range
+            url.port
+            status_matches(0, properties.get('SuccessCodes', '200-399'))
+        else:
+            if not properties['Host'] or not 0 < int(properties['Port']) < 65536:
+                raise ValueError(f"invalid Host or Port {properties['Port']}")
+    except KeyError as e:
+        raise ValueError(f"{probe['Provider']} probe: missing property {str(e)}")
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"{probe['Provider']} probe: {str(e)}")
+
+
+def ecs_probe_items(probes):
+    """Return {item: properties} of Ecs probes"""
+    return {
+        f'ecs-probe-{str(idx)}': probe.get('Properties', {})
+        for idx, probe in enumerate(probes) if probe['Provider'] == 'Ecs'
+    }
+
+
+def ecs_services(properties):
+    """Return (cluster, [service]) of an Ecs probe, Services can be given
+    as list or comma separated string"""
+    services = properties.get('Services', properties.get('Service', []))
+    if isinstance(services, str):
+        services = [service.strip() for service in services.split(',') if service.strip()]
+    return properties.get('Cluster', 'default'), services
+
+
+def ecs_probe_validate(properties):
+    """Raise ValueError on an Ecs probe without services -- checked once on
+    Create/Update, the probe would stay pending until the wait times out"""
+    cluster, services = ecs_services(properties)
+    if not isinstance(services, list) or not services \
+            or not all(isinstance(service, str) and service for service in services):
+        raise ValueError(f'Ecs probe: no Services given for cluster {cluster}')
+    if not isinstance(cluster, str) or not cluster:
+        raise ValueError('Ecs probe: invalid Cluster')
+
+
+def ecs_describe(cluster, services):
+    """Return {service: description} of a batch of services, keyed by the
+    name or arn as requested. Missing services are left out, as are all
+    services of a batch that fails on a (client) error -- e.g. a cluster that
+    is still being created, these remain pending"""
+    try:
+        response = client('ecs', retries=ADAPTIVE).describe_services(
+            cluster=cluster, services=services)
+    except Exception as e:
+        if not error_code(e):
+            raise
+        logger.info(f'describe_services on {cluster} failed: {str(e)}')
+        return {}
+    described = {}
+    for service in response.get('services', []):
+        described[service['serviceName']] = service
+        described[service['serviceArn']] = service
+    return {name: described[name] for name in services if name in described}
+
+
+def ecs_service_status(service):
+    """SUCCESS when the deployment has rolled out and running tasks match
+    the desired count, FAILED on a failed rollout, else None"""
+    if service is None or service.get('status') != 'ACTIVE':
+        return None
+    deployments = service.get('deployments', [])
+    primary = [item for item in deployments if item.get('status') == 'PRIMARY']
+    if primary and primary[0].get('rolloutState') == 'FAILED':
+        return 'FAILED'
+    if len(deployments) == 1 and primary \
+            and primary[0].get('rolloutState', 'COMPLETED') == 'COMPLETED' \
+            and primary[0]['runningCount'] == primary[0]['desiredCount'] \
+            and service['runningCount'] == service['desiredCount']:
+        return 'SUCCESS'
+    return None
+
+
+def ecs_probes_status(ecs_probes, timeout=PROBE_TIMEOUT_SECONDS):
+    """Return {item: (status, detail)} of Ecs probes. Services of all probes
+    are described together, in batches per cluster"""
+    clusters = {}
+    for properties in ecs_probes.values():
+        cluster, services = ecs_services(properties)
+        clusters.setdefault(cluster, set()).update(services)
+    batches = {
+        (cluster, idx): (cluster, names[idx:idx + ECS_BATCH_SIZE])
+        for cluster, names in [(key, sorted(value)) for key, value in clusters.items()]
+        for idx in range(0, len(names), ECS_BATCH_SIZE)
+    }
+    described = {}
+    for (cluster, _), services in concurrent_map(ecs_describe, batches, timeout).items():
+        described.update({(cluster, name): service for name, service in services.items()})
+
+    results = {}
+    for item, properties in ecs_probes.items():
+        cluster, services = ecs_services(properties)
+        statuses = {
+            name: ecs_service_status(described.get((cluster, name)))
+            for name in services
+        }
+        if 'FAILED' in statuses.values():
+            status = 'FAILED'
+        elif services and all(value == 'SUCCESS' for value in statuses.values()):
+            status = 'SUCCESS'
+        else:
+            status = None
+        pending = [name for name, value in statuses.items() if value != 'SUCCESS']
+        results[item] = (status, f'{cluster}: not stable: {pending}' if pending else cluster)
+    return results
+
+
 def eventrule_exists(name):
     """Check if eventrule exists"""
     try:
-        if events_client.describe_rule(Name=name)['Name'] == name:
+        if client('events').describe_rule(Name=name)['Name'] == name:
             return True
-    except events_client.exceptions.ResourceNotFoundException:
+    except client('events').exceptions.ResourceNotFoundException:
         return False
     except Exception as e:
         raise Exception(e)
     return False
 
 
-def targets_update(name, lambda_arn, event):
-    logger.info(f'adding targets for {name}')
-
+def target_input(name, event):
+    """Compose the input of repeating (via Eventrule) Lambda invocations"""
     expire_time = \
         datetime.now(timezone.utc) \
         + timedelta(minutes=int(event['ResourceProperties']['TimeoutInMinutes']))
@@ -94,30 +353,117 @@ def targets_update(name, lambda_arn, event):
         },
         'ExpireTime': expire_time.isoformat()
     }
+    # echo an existing PhysicalResourceId, e.g. of a wait handed over by
+    # another custom resource, a new id would replace that resource
+    if event.get('PhysicalResourceId'):
+        input_data['SourceEvent']['PhysicalResourceId'] = event['PhysicalResourceId']
+
+    # region and presigned POST data are computed once, re-used on each tick
+    lambda_probes = lambda_probe_items(event['ResourceProperties'].get('Probes', []))
+    if lambda_probes:
+        bucket_name = waiter_bucket()
+        input_data['BucketRegion'] = bucket_region_get(bucket_name)
+        input_data['ResponseUrlData'] = {
+            item: presigned_data(
+                bucket_name, waiter_key(name, item), input_data['BucketRegion'])
+            for item in lambda_probes.keys()
+        }
+    return input_data
+
 
-    response = events_client.put_targets(
+def targets_update(name, lambda_arn, input_data):
+    logger.info(f'adding targets for {name}')
+
+    input_str = json.dumps(input_data)
+    response = client('events').put_targets(
         Rule=name,
         Targets=[
             {
                 'Arn': lambda_arn,
                 'Id': 'Self',
-                'Input': json.dumps(input_data)
+                'Input': input_str
             }
         ]
     )
     logger.info(response)
+    return input_data
+
+
+def wait_record_put(input_data):
+    """Store a wait (target input) in the bucket, return a reference to it.
+    The eventrule target Input (max 8 KB) only carries this reference, so
+    the number and size of probes is not limited by it"""
+    bucket_key = waiter_key(input_data['Name'], 'input.json')
+    response = client('s3').put_object(
+        Bucket=waiter_bucket(),
+        Key=bucket_key,
+        Body=json.dumps(input_data).encode()
+    )
+    _fetch_cache[bucket_key] = (response['ETag'], input_data)
+    return {'Name': input_data['Name'], 'WaitRecord': bucket_key, 'ETag': response['ETag']}
+
+
+def wait_record_get(reference):
+    """Return the wait of a reference (target Input). Taken from cache if the
+    etag matches, else fetched -- on condition it still has that etag"""
+    bucket_key = reference['WaitRecord']
+    cached = _fetch_cache.get(bucket_key)
+    if cached and cached[0] == reference['ETag']:
+        return cached[1]
+    response = client('s3').get_object(
+        Bucket=waiter_bucket(),
+        Key=bucket_key,
+        IfMatch=reference['ETag']
+    )
+    input_data = json.loads(response['Body'].read().decode('utf-8'))
+    _fetch_cache[bucket_key] = (reference['ETag'], input_data)
+    return input_data
+
+
+def wait_record_lost(reference):
+    """Delete the eventrule of a wait whose record is gone, or replaced while
+    the target was not updated (e.g. a failed Update) -- ticks would continue
+    without expiry. A tick scheduled before its target was updated carries an
+    outdated reference, the rule is left in place for those"""
+    name = reference['Name']
+    if eventrule_exists(name) is False:
+        return {}
+    targets = client('events').list_targets_by_rule(Rule=name, Limit=1).get('Targets', [])
+    for target in targets:
+        if json.loads(target.get('Input', '{}')).get('ETag') != reference['ETag']:
+            return {}
+    logger.info(f"Wait record {reference['WaitRecord']} lost, deleting eventrule")
+    return eventrule_delete(name)
 
 
-def eventrule_update(name, pause_time_in_minutes=1):
+def error_code(e):
+    """Error code of a (botocore) ClientError, empty for other exceptions"""
+    return getattr(e, 'response', {}).get('Error', {}).get('Code', '')
+
+
+def wait_objects_delete(name):
+    """Remove all objects of a wait: its record, probe states and results"""
+    keys = list(bucket_listing(waiter_key(name, '')).keys())
+    # delete_objects accepts at most 1000 keys per call
+    for idx in range(0, len(keys), 1000):
+        client('s3').delete_objects(
+            Bucket=waiter_bucket(),
+            Delete={'Objects': [{'Key': key} for key in keys[idx:idx + 1000]], 'Quiet': True}
+        )
+    for key in keys:
+        _fetch_cache.pop(key, None)
+
+
+def eventrule_update(name, pause_time_in_minutes=1, state='ENABLED'):
     """Create or Update event rule"""
     # ScheduleExpression='cron(0/1 * * * ? *)',
 
     expression = \
         f"rate({pause_time_in_minutes} minute{pause_time_in_minutes > 1 and 's' or ''})"
-    response = events_client.put_rule(
+    response = client('events').put_rule(
         Name=name,
         ScheduleExpression=expression,
-        State='ENABLED',
+        State=state,
         Description='string',
     )
 
@@ -130,10 +476,10 @@ def eventrule_delete(name):
     """Delete Event Rule -- related targets included"""
     # expect max 1 target
     target_list = \
-        events_client.list_targets_by_rule(Rule=name, Limit=1).get('Targets', [])
+        client('events').list_targets_by_rule(Rule=name, Limit=1).get('Targets', [])
     target_ids = [target['Id'] for target in target_list]
-    _ = events_client.remove_targets(Rule=name, Ids=target_ids)
-    events_client.delete_rule(Name=name)
+    _ = client('events').remove_targets(Rule=name, Ids=target_ids)
+    client('events').delete_rule(Name=name)
 
     return {
         'Message': f'Deleted eventrule: {name}'
@@ -150,32 +496,227 @@ def eventrule(request_type, event, lambda_arn):
         length=64
     )
 
+    if is_multiplex(payload):
+        if request_type == 'Delete':
+            return multiplex_deregister(rule_name)
+        # waiter may have been switched to multiplex mode on Update
+        if eventrule_exists(rule_name) is True:
+            eventrule_delete(rule_name)
+        return multiplex_register(target_input(rule_name, event), lambda_arn)
+
     if request_type == 'Delete':
-        if eventrule_exists(rule_name) is False:
-            return {}
-        return eventrule_delete(rule_name)
+        # objects are removed also when the wait completed (or was lost)
+        response = {}
+        if eventrule_exists(rule_name) is True:
+            response = eventrule_delete(rule_name)
+        wait_objects_delete(rule_name)
+        return response
     else:
         eventrule_update(
             rule_name,
             pause_time_in_minutes=int(payload.get('PauseTimeInMinutes', '1'))
         )
-        targets_update(rule_name, lambda_arn, event)
+        input_data = target_input(rule_name, event)
+        targets_update(rule_name, lambda_arn, wait_record_put(input_data))
+        return input_data
+    return {}
+
+
+def multiplex_rule_name():
+    """Name of the eventrule shared by all multiplexed waiters"""
+    return trim_alphanum(f"{os.environ['S3BucketPrefix']}-waiter", length=64)
+
+
+def multiplex_register(input_data, lambda_arn):
+    """Register a wait record, ensure the shared eventrule is enabled"""
+    client('s3').put_object(
+        Bucket=waiter_bucket(),
+        Key=waiter_key(input_data['Name'], 'wait.json'),
+        Body=json.dumps(input_data).encode()
+    )
+    # record must be written before the rule is (re-)enabled, see multiplex_idle
+    rule_name = multiplex_rule_name()
+    eventrule_update(rule_name)
+    targets_update(rule_name, lambda_arn, {'MultiplexRule': rule_name})
+    return input_data
+
+
+def multiplex_deregister(name):
+    """Remove a wait record, probe states and results -- shared eventrule
+    is disabled when idle"""
+    wait_objects_delete(name)
+    return {'Message': f'Deregistered wait: {name}'}
+
+
+def multiplex_waits(listing=None):
+    """Return {bucket_key: wait record} of all registered waits"""
+    if listing is None:
+        listing = bucket_listing(os.environ['S3BucketPrefix'] + '/')
+    records = listing_fetch(listing, [
+        key for key in listing.keys() if key.endswith('/wait.json')
+    ])
+    return {
+        key: record for key, record in records.items()
+        if isinstance(record, dict) and record.get('SourceEvent')
+    }
+
+
+def multiplex_idle(rule_name):
+    """Disable the shared eventrule when no waits are registered.
+    Registration writes its record before it enables the rule -- re-check
+    after disabling so a concurrent registration keeps its trigger"""
+    eventrule_update(rule_name, state='DISABLED')
+    if multiplex_waits():
+        eventrule_update(rule_name)
     return {}
 
 
-def eventrule_reinvoke(event, context):
+def probe_executor():
+    """Shared (warm container) thread pool for probe calls"""
+    global _probe_executor
+    if _probe_executor is None:
+        _probe_executor = ThreadPoolExecutor(max_workers=PROBE_WORKERS)
+    return _probe_executor
+
+
+def concurrent_map(function, arguments, timeout=PROBE_TIMEOUT_SECONDS):
+    """Call function for each {key: args} item on the probe executor.
+    Returns {key: result} in order of arguments -- calls that did not finish
+    within timeout (per probe) are left out, exceptions are re-raised"""
+    futures = {
+        key: probe_executor().submit(function, *args)
+        for key, args in arguments.items()
+    }
+    # calls beyond PROBE_WORKERS are queued -- extend the timeout per batch
+    batches = max(1, -(-len(futures) // PROBE_WORKERS))
+    done, _ = wait(futures.values(), timeout=timeout * batches)
+
+    results = {}
+    for key, future in futures.items():
+        if future not in done:
+            future.cancel()
+            logger.info(f'{key}: no result within {timeout} seconds')
+            continue
+        results[key] = future.result()
+    return results
+
+
+def json_fetch(bucket_name, bucket_key):
+    """Return the (json) contents of a bucket item -- None if not available"""
+    try:
+        response = client('s3').get_object(Bucket=bucket_name, Key=bucket_key)
+        return json.loads(response['Body'].read().decode('utf-8'))
+    except Exception as e:
+        logger.info(f"cant fetch:{bucket_key},error={str(e)}")
+    return None
+
+
+def bucket_listing(prefix):
+    """Return {bucket_key: etag} of all items under prefix (one listing)"""
+    paginator = client('s3').get_paginator('list_objects_v2')
+    listing = {
+        item['Key']: item['ETag']
+        for page in paginator.paginate(Bucket=waiter_bucket(), Prefix=prefix)
+        for item in page.get('Contents', [])
+    }
+    # forget cached items that no longer exist
+    for key in [key for key in _fetch_cache if key.startswith(prefix)]:
+        if key not in listing:
+            del _fetch_cache[key]
+    return listing
+
+
+def listing_fetch(listing, keys, timeout=PROBE_TIMEOUT_SECONDS):
+    """Return {bucket_key: contents} for keys that exist in listing. Only
+    new or changed (etag) items are fetched, others come from the cache"""
+    bucket_name = waiter_bucket()
+    fetch_keys = [
+        key for key in keys
+        if key in listing and _fetch_cache.get(key, (None,))[0] != listing[key]
+    ]
+    fetched = concurrent_map(
+        json_fetch, {key: (bucket_name, key) for key in fetch_keys}, timeout=timeout)
+    for key, contents in fetched.items():
+        if contents is not None:
+            _fetch_cache[key] = (listing[key], contents)
+    return {
+        key: _fetch_cache[key][1] for key in keys
+        if key in listing and key in _fetch_cache
+    }
+
+
+def probe_invoke(service_token, event_data, response_url_data):
+    """Invoke (async) a Lambda probe"""
+    # append S3 Presigned data to properties
+    response_url_data = {
+        key: value for key, value in response_url_data.items() if key != 'Expires'
+    }
+
+    response = client('lambda').invoke(
+        FunctionName=service_token,
+        InvocationType='Event',
+        LogType='None',
+        Payload=json.dumps(
+            dict(event_data, ResponseUrlData=response_url_data)).encode()
+    )
+
+    # logger.info( json.dumps( response, default=str ) )
+    # according to specs, Lambda event invoke-types should return 202
+    # in practice we sometimes receive a 200 -- include 201 just in case
+    if response['StatusCode'] not in [200, 201, 202]:
+        raise Exception(f'Failed to invoke:{service_token}')
+    return response['StatusCode']
+
+
+def probe_states(contents, request_id):
+    """Return {item: state} of Lambda probes, as stored (state.json) for
+    this request -- state of an earlier request is discarded"""
+    if not isinstance(contents, dict) or contents.get('RequestId') != request_id:
+        return {}
+    return dict(contents.get('Probes', {}))
+
+
+def probe_in_flight(state, result, result_etag, grace):
+    """Check if a probe was invoked within grace seconds and has not
+    answered since: its result is unchanged and does not echo the Invocation"""
+    if not state or state.get('Status') != 'IN_FLIGHT':
+        return False
+    if isinstance(result, dict) and result.get('Invocation') == state['Invocation']:
+        return False
+    return state.get('ResultETag') == result_etag \
+        and time.time() - state['InvokedAt'] < grace
+
+
+def probe_states_write(bucket_key, request_id, states):
+    """Store probe states, cache them under the new etag so an unchanged
+    state.json is not fetched again on the next listing"""
+    contents = {'RequestId': request_id, 'Probes': states}
+    response = client('s3').put_object(
+        Bucket=waiter_bucket(),
+        Key=bucket_key,
+        Body=json.dumps(contents).encode()
+    )
+    _fetch_cache[bucket_key] = (response['ETag'], contents)
+
+
+def eventrule_reinvoke(event, context, listing=None):
     """
+    Probe results are read from listing ({bucket_key: etag}), if not given
+    the results of this waiter are listed.
     Function should only be exited in one of these three ways:
     - return {}: eventrule stays in place
     - return {'some_key': 'some_value'}: delete eventrule + signal SUCCESS
     - Exception: delete eventrule + signal FAILED"""
-    logger.info( json.dumps( event ))
+    # presigned data is left out of the logs
+    logger.info( json.dumps(
+        {key: value for key, value in event.items() if key != 'ResponseUrlData'}))
 
     expired = datetime.now(timezone.utc) > datetime.fromisoformat(event['ExpireTime'])
 
     request_id = event['SourceEvent']['RequestId']
     payload = event['SourceEvent']['ResourceProperties']
     probes = payload.get('Probes', [])
+    timeout = float(payload.get('ProbeTimeoutInSeconds', PROBE_TIMEOUT_SECONDS))
 
     if not probes:
         if expired:
@@ -183,103 +724,287 @@ def eventrule_reinvoke(event, context):
         # nothing to probe -- which is fine, TimeoutInMinutes feature is still useful
         return {}
 
-    # only lambda probes are currently supported
-    lambda_probes = {
-        f'lambda-probe-{str(idx)}': probe['Properties']
-        for idx, probe in enumerate(probes) if probe['Provider'] == 'Lambda'
-    }
+    # lambda probes, plus Http and Tcp probes that are run in-process
+    lambda_probes = lambda_probe_items(probes)
+    native_probes = native_probe_items(probes)
+    ecs_probes = ecs_probe_items(probes)
     misc_probes = [
         probe['Provider']
-        for probe in probes if probe['Provider'] != 'Lambda'
+        for probe in probes if probe['Provider'] not in ['Lambda', 'Ecs'] + NATIVE_PROVIDERS
     ]
     if misc_probes:
         logger.info(f"Provider(s) {','.join(misc_probes)} not (yet) supported")
 
     probe_results = {
-        item: {'bucket_key': '/'.join([os.environ['S3BucketPrefix'], item])}
+        item: {'bucket_key': waiter_key(event['Name'], item)}
         for item in lambda_probes.keys()
     }
 
-    bucket_name = re.sub('.*:', '', os.environ['S3BucketArn'])
+    bucket_name = waiter_bucket()
+
+    # scan probe results for Status updates -- items that are not listed
+    # have not been written yet, unchanged items are taken from cache
+    if listing is None and lambda_probes:
+        try:
+            listing = bucket_listing(waiter_key(event['Name'], ''))
+        except Exception as e:
+            if not error_code(e):
+                raise
+            # e.g. throttled, retried on the next tick
+            logger.info(f"cant list:{waiter_key(event['Name'], '')},error={str(e)}")
+            return {}
+    state_key = waiter_key(event['Name'], 'state.json')
+    fetched = listing_fetch(
+        listing or {},
+        [conf['bucket_key'] for conf in probe_results.values()] + [state_key],
+        timeout=timeout
+    )
 
-    # scan probe results for Status updates
     failure_detected = []
     success_detected = []
     for item, conf in probe_results.items():
-        try:
-            response = s3_client.get_object(
-                Bucket=bucket_name,
-                Key=conf['bucket_key']
-            )
-            contents = json.loads(response['Body'].read().decode('utf-8'))
-
-            if contents['RequestId'] != request_id:
-                # not an updated item
-                continue
-
-            status = contents.get('ResponseStatus', None)
-            if not isinstance(status, str):
-                continue
-            if status == 'FAILED':
-                failure_detected.append(item)
-            elif status == 'SUCCESS':
-                success_detected.append(item)
-
-            response = contents.get('ResponseData', None)
-            if response:
-                logger.info(f'Probe \'{item}\' {status} with response: {json.dumps(response)}')
-            else:
-                logger.info(f'Probe \'{item}\' {status} without response')
-
-        except Exception as e:
-            logger.info(f"cant fetch:{conf['bucket_key']},error={str(e)}")
+        contents = fetched.get(conf['bucket_key'])
+        if not isinstance(contents, dict) or contents.get('RequestId') != request_id:
+            # not an updated item
+            continue
+
+        status = contents.get('ResponseStatus', None)
+        if not isinstance(status, str):
+            continue
+        if status == 'FAILED':
+            failure_detected.append(item)
+        elif status == 'SUCCESS':
+            success_detected.append(item)
+
+        response = contents.get('ResponseData', None)
+        if response:
+            logger.info(f'Probe \'{item}\' {status} with response: {json.dumps(response)}')
+        else:
+            logger.info(f'Probe \'{item}\' {status} without response')
+
+    # Http and Tcp probes are run right here, concurrently -- a probe that
+    # does not answer within its timeout counts as not (yet) ready
+    native_results = concurrent_map(
+        native_probe,
+        {item: (probe, timeout) for item, probe in native_probes.items()},
+        timeout=max([timeout] + [
+            float(probe.get('Properties', {}).get('TimeoutInSeconds', timeout))
+            for probe in native_probes.values()
+        ])
+    )
+    # Ecs probes share describe_services calls, batched per cluster
+    if ecs_probes:
+        native_results.update(ecs_probes_status(ecs_probes, timeout=timeout))
+    for item, (status, detail) in native_results.items():
+        logger.info(f"Probe '{item}' {status or 'PENDING'}: {detail}")
+        if status == 'FAILED':
+            failure_detected.append(item)
+        elif status == 'SUCCESS':
+            success_detected.append(item)
 
     if failure_detected:
         raise Exception(f"Probe(s) {str(failure_detected)} FAILED")
 
-    if len(success_detected) == len(probe_results.keys()):
+    probe_count = len(probe_results.keys()) + len(native_probes.keys()) + len(ecs_probes.keys())
+    if len(success_detected) == probe_count:
         return {'Message': 'All probes returned SUCCESS'}
 
     if expired:
         # probes must have failed
         raise TimeoutError
 
-    bucket_region = \
-        s3_client.get_bucket_location(Bucket=bucket_name)['LocationConstraint']
-
-    for item, properties in lambda_probes.items():
-        service_token = properties['ServiceToken']
+    if not lambda_probes:
+        return {}
 
-        # append S3 Presigned data to properties
-        response_url_data = presigned_post_url(
-            bucket_name,
-            '/'.join([os.environ['S3BucketPrefix'], item])
-        )
-        # overwrite URL with the Regional version to prevent 307 redirects
-        response_url_data['Url'] = \
-            f"https://{bucket_name}.s3-{bucket_region}.amazonaws.com/"
-
-        event_data = {
-            'RequestType': 'StatusUpdate',
-            'ResourceProperties': properties,
-            'ResponseUrlData': response_url_data,
-            'RequestId': request_id,
-            'StackId': event['SourceEvent'].get('StackId', '')
+    # per-probe state: PENDING probes are marked IN_FLIGHT and invoked,
+    # SUCCEEDED probes are settled -- a FAILED probe ended the wait above
+    states = probe_states(fetched.get(state_key), request_id)
+    stored_states = dict(states)
+    grace = float(payload.get('ProbeGraceInSeconds', PROBE_GRACE_SECONDS))
+    for item, conf in probe_results.items():
+        if item in success_detected:
+            states[item] = {'Status': 'SUCCEEDED'}
+        elif not probe_in_flight(
+                states.get(item), fetched.get(conf['bucket_key']),
+                listing.get(conf['bucket_key']), grace):
+            states[item] = {'Status': 'PENDING'}
+    pending = [item for item, state in states.items() if state['Status'] == 'PENDING']
+    logger.info(
+        f'Invoking probe(s) {pending}, '
+        f'{len(lambda_probes) - len(pending)} settled or in flight')
+
+    # marked before invoking: an invoke that outlives timeout (it can not be
+    # cancelled once running) is not repeated while the marker holds
+    for item in pending:
+        states[item] = {
+            'Status': 'IN_FLIGHT',
+            'Invocation': uuid.uuid4().hex,
+            'InvokedAt': time.time(),
+            'ResultETag': listing.get(probe_results[item]['bucket_key'])
         }
+    if states != stored_states:
+        try:
+            probe_states_write(state_key, request_id, states)
+        except Exception as e:
+            if not error_code(e):
+                raise
+            # invoked without marker, as if the probes were all PENDING
+            logger.info(f'cant store:{state_key},error={str(e)}')
+
+    bucket_region = event.get('BucketRegion') or bucket_region_get(bucket_name)
+    stored = event.get('ResponseUrlData', {})
+    concurrent_map(
+        probe_invoke,
+        {
+            item: (
+                lambda_probes[item]['ServiceToken'],
+                {
+                    'RequestType': 'StatusUpdate',
+                    'ResourceProperties': lambda_probes[item],
+                    'RequestId': request_id,
+                    'StackId': event['SourceEvent'].get('StackId', ''),
+                    'Invocation': states[item]['Invocation']
+                },
+                presigned_data(
+                    bucket_name,
+                    probe_results[item]['bucket_key'],
+                    bucket_region,
+                    stored=stored.get(item)
+                )
+            )
+            for item in pending
+        },
+        timeout=timeout
+    )
+    return {}
 
-        response = lambda_client.invoke(
-            FunctionName=service_token,
-            InvocationType='Event',
-            LogType='None',
-            Payload=json.dumps(event_data).encode()
-        )
 
-        # logger.info( json.dumps( response, default=str ) )
-        # according to specs, Lambda event invoke-types should return 202
-        # in practice we sometimes receive a 200 -- include 201 just in case
-        if response['StatusCode'] not in [200, 201, 202]:
-            raise Exception(f'Failed to invoke:{service_token}')
+def poll_delays(interval, max_interval, factor=2):
+    """Yield pause times (seconds), exponential backoff with jitter"""
+    delay = interval
+    while True:
+        # equal jitter -- spread re-checks of concurrent waiters
+        yield random.uniform(delay / 2, delay)
+        delay = min(delay * factor, max_interval)
+
+
+def poll_settings(event):
+    """Return (interval, max_interval, window_end) for sub-minute polling"""
+    payload = event['SourceEvent']['ResourceProperties']
+    interval = float(payload.get('PollIntervalInSeconds', '0'))
+    max_interval = float(payload.get('PollMaxIntervalInSeconds', '30'))
+    window_end = \
+        datetime.fromisoformat(event['ExpireTime']) \
+        - timedelta(minutes=int(payload['TimeoutInMinutes'])) \
+        + timedelta(minutes=int(payload.get('PollWindowInMinutes', '10')))
+    return interval, max(interval, max_interval), window_end
+
+
+def poll_repeat(check, settings, context):
+    """Repeat check() at sub-minute intervals until it returns a response.
+    Repeats are bounded by the poll window and the remaining invocation time"""
+    interval, max_interval, window_end = settings
+    if interval <= 0:
+        return {}
 
+    for delay in poll_delays(interval, max_interval):
+        if datetime.now(timezone.utc) + timedelta(seconds=delay) > window_end:
+            break
+        if context.get_remaining_time_in_millis() / 1000 < delay + POLL_MARGIN_SECONDS:
+            break
+        time.sleep(delay)
+        response = check()
+        if response:
+            return response
+    return {}
+
+
+def eventrule_poll(event, context):
+    """Run eventrule_reinvoke, repeat it at sub-minute intervals when
+    PollIntervalInSeconds is set. Repeats are bounded by PollWindowInMinutes
+    (counted from the start of the wait) and the remaining invocation time.
+    Long waits fall back on the eventrule (PauseTimeInMinutes) only"""
+    response = eventrule_reinvoke(event, context)
+    if response:
+        return response
+    return poll_repeat(
+        lambda: eventrule_reinvoke(event, context), poll_settings(event), context)
+
+
+def eventrule_outcome(check, event, context):
+    """Run check, return (status, data) once the wait is over, else None"""
+    # pass all exceptions to ensure the wait gets closed
+    try:
+        response = check(event, context)
+        if not response:
+            # re-Invoke initiated -- wait stays in place
+            return None
+        # response without exceptions -- exit with SUCCESS
+        return 'SUCCESS', response
+    except TimeoutError:
+        return 'FAILED', {'Message': 'TIMEOUT'}
+    except Exception as e:
+        return 'FAILED', {'Message': str(e)}
+
+
+def eventrule_tick(event, context):
+    """Poll probes, on completion signal CloudFormation and close the wait"""
+    outcome = eventrule_outcome(eventrule_poll, event, context)
+    if outcome is None:
+        return {}
+    nofail_send(event.get('SourceEvent', {}), context, *outcome)
+
+    if is_multiplex(event['SourceEvent'].get('ResourceProperties', {})):
+        multiplex_deregister(event['Name'])
+        return {}
+
+    # in any case, except re-Invoke, delete eventrule
+    # provided it still exists
+    if eventrule_exists(event.get('Name', '')) is True:
+        eventrule_delete(event['Name'])
+    wait_objects_delete(event['Name'])
+    return {}
+
+
+def multiplex_tick(event, context):
+    """Drive all registered waits from the shared eventrule -- each wait
+    keeps its own probes, timeout and CloudFormation response"""
+    prefix = os.environ['S3BucketPrefix'] + '/'
+    listing = bucket_listing(prefix)
+    pending = multiplex_waits(listing)
+    if not pending:
+        return multiplex_idle(event['MultiplexRule'])
+
+    def check(listing=None):
+        # one listing per round covers the probe results of all waits
+        if listing is None:
+            listing = bucket_listing(prefix)
+        for key, wait_event in list(pending.items()):
+            outcome = eventrule_outcome(
+                lambda *args: eventrule_reinvoke(*args, listing=listing),
+                wait_event, context
+            )
+            if outcome is None:
+                continue
+            nofail_send(wait_event['SourceEvent'], context, *outcome)
+            multiplex_deregister(wait_event['Name'])
+            del pending[key]
+        if not pending:
+            return {'Message': 'All registered waits completed'}
+        return {}
+
+    if check(listing):
+        return {}
+
+    # sub-minute polling, when enabled on at least one of the waits
+    settings = [poll_settings(wait_event) for wait_event in pending.values()]
+    settings = [item for item in settings if item[0] > 0]
+    if settings:
+        poll_repeat(check, (
+            min(item[0] for item in settings),
+            min(item[1] for item in settings),
+            max(item[2] for item in settings)
+        ), context)
     return {}
 
 
@@ -287,7 +1012,7 @@ def nofail_send(event, context, status, data):
     """Non-failing send -- log only"""
     try:
         logger.info(json.dumps({'ResponseStatus': status, 'ResponseData': data}))
-        send_cfnresponse(event, context, status, data)
+        send(event, context, status, data, event.get('PhysicalResourceId'))
     except Exception as e:
         logger.info(f'send(..) failed executing requests.put(..): {str(e)}')
 
@@ -303,20 +1028,28 @@ def handler(event, context):
             # logger.info( json.dumps( event ))
             success_count = int(event['ResourceProperties'].get('SuccessCount', 1))
             if success_count > 0:
-                return eventrule(
+                probes = event['ResourceProperties'].get('Probes', [])
+                for probe in native_probe_items(probes).values():
+                    native_probe_validate(probe)
+                for properties in ecs_probe_items(probes).values():
+                    ecs_probe_validate(properties)
+                rule_input = eventrule(
                     request_type,
                     event,
                     context.invoked_function_arn
                 )
+                # start checking right away, the eventrule takes over
+                # (PauseTimeInMinutes) when this invocation runs out of time
+                return eventrule_tick(rule_input, context)
             else:
                 # success_count <= 0 bypasses the function. This property is also useful if
                 # chained with resources that output 0 or 1 to signal a wait requirement
-                send_cfnresponse(
+                send(
                     event, context, 'SUCCESS', {}, event['LogicalResourceId']
                 )
                 return {}
         elif request_type in ['Delete']:
-            send_cfnresponse(event, context, 'SUCCESS',
+            send(event, context, 'SUCCESS',
                  eventrule(
                     request_type,
                     event,
@@ -328,7 +1061,7 @@ def handler(event, context):
     except Exception as e:
         if event.get('ResponseURL', ''):
             logger.info(f'HandlerException:{str(e)}')
-            send_cfnresponse(event, context, 'FAILED', {})
+            send(event, context, 'FAILED', {'Message': str(e)})
         else:
             logger.info(f'HandlerException:{str(e)}')
         return {}
@@ -336,62 +1069,18 @@ def handler(event, context):
     # assume triggered via EventRule as a repeating invocation
     if not isinstance(event, dict):
         raise ValueError(f'Input error, dictionary expected on EventRule invocation')
+    if event.get('MultiplexRule', ''):
+        return multiplex_tick(event, context)
+    if event.get('WaitRecord', ''):
+        try:
+            event = wait_record_get(event)
+        except Exception as e:
+            logger.info(f"cant fetch:{event['WaitRecord']},error={str(e)}")
+            if error_code(e) in ['NoSuchKey', 'PreconditionFailed']:
+                return wait_record_lost(event)
+            # e.g. throttled, retried on the next tick
+            return {}
     if not event.get('SourceEvent', ''):
         raise ValueError(f'Input error, key SourceEvent missing on EventRule invocation')
 
-    # pass all exceptions to ensure final eventrule_delete function gets hit
-    try:
-        response = eventrule_reinvoke(event, context)
-        if not response:
-            # re-Invoke initiated -- return without hitting eventrule_delete
-            return {}
-        # response without exceptions -- exit with SUCCESS
-        nofail_send(event.get('SourceEvent', {}), context, 'SUCCESS', response)
-    except TimeoutError:
-        nofail_send(event.get('SourceEvent', {}), context, 'FAILED', {'Message': 'TIMEOUT'})
-        pass
-    except Exception as e:
-        nofail_send(event.get('SourceEvent', {}), context, 'FAILED', {'Message': str(e)})
-        pass
-
-    # in any case, except re-Invoke, delete eventrule
-    # provided it still exists
-    if eventrule_exists(event.get('Name', '')) is True:
-        eventrule_delete(event['Name'])
-
-
-def send_cfnresponse(
-        event, context, response_status, response_data,
-        physicalResourceId=None, noEcho=False
-    ):
-    response_url = event['ResponseURL']
-
-    response_body = {
-        'Status' : response_status,
-        'Reason': f'See the details in CloudWatch Log Stream: {context.log_group_name}',
-        'PhysicalResourceId': physicalResourceId or context.log_stream_name,
-        'StackId': event['StackId'],
-        'RequestId': event['RequestId'],
-        'LogicalResourceId': event['LogicalResourceId'],
-        'NoEcho': noEcho,
-        'Data': response_data
-    }
-
-    json_responseBody = json.dumps(response_body)
-
-    headers = {
-        'content-type': '',
-        'content-length': str(len(json_responseBody))
-    }
-
-    try:
-        req = urllib.request.Request(
-            response_url,
-            data=json_responseBody.encode(),
-            headers=headers,
-            method='PUT'
-        )
-        with urllib.request.urlopen(req) as response:
-            logger.info(f'Status code: {str(response.getcode())}')
-    except Exception as e:
-        logger.info(f'send(..) failed executing requests.put(..): {str(e)}')
+    return eventrule_tick(event, context)
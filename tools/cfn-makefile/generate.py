@@ -7,16 +7,64 @@
 import os
 import re
 import sys
+import json
 import time
+import hashlib
+import argparse
 import datetime
 
 
 epoch_in_milliseconds = lambda: round(time.time()*10**3)
 iso_8601_date = lambda: f'{datetime.datetime.utcnow().isoformat()}+00:00'
 
-def generate_makefile(template, filemap):
-    """Read file, replace {{ parameter-key }} with {{ parameter-value } and
-    write updated contents"""
+# replace labels, e.g. {{ KEY }}
+LABEL_PATTERN = re.compile('{{ ?.*? ?}}')
+
+# inserted files are read (and escaped) in chunks of this size
+CHUNK_SIZE = 65536
+
+
+def file_chunks(path, chunk_size=CHUNK_SIZE):
+    """Yield file contents in chunks, stripped of leading and trailing
+    whitespace, with $ escaped by $ as makefile requires"""
+    with open(path, 'r') as stream:
+        # trailing whitespace is held back until followed by content
+        pending = ''
+        started = False
+        for chunk in iter(lambda: stream.read(chunk_size), ''):
+            if not started:
+                chunk = chunk.lstrip()
+                if not chunk:
+                    continue
+                started = True
+            stripped = chunk.rstrip()
+            if not stripped:
+                pending += chunk
+                continue
+            yield (pending + stripped).replace('$', '$$')
+            pending = chunk[len(stripped):]
+
+
+def insert_chunks(key, item, called):
+    """Return chunks to insert for {{ key }}, callable values are called once
+    (per run) and memoised in called"""
+    if isinstance(item, str) and os.path.isfile(item):
+        # file contents to be inserted
+        return file_chunks(item)
+    elif isinstance(item, str):
+        return [item]
+    elif isinstance(item, int):
+        return [str(item)]
+    elif hasattr(item, '__call__'):
+        if key not in called:
+            called[key] = str(item())
+        return [called[key]]
+    raise TypeError(f'Unsupported replacement type:{type(item)} for {key}')
+
+
+def generate_makefile(template, filemap, output):
+    """Read template, replace {{ parameter-key }} with {{ parameter-value }}
+    and write the updated contents to output (stream) in a single pass"""
     if not isinstance(template, str):
         raise TypeError('template should be formatted as a string')
     if not isinstance(filemap, dict):
@@ -26,32 +74,71 @@ def generate_makefile(template, filemap):
     with open(template, 'r') as stream:
         contents = stream.read().strip()
 
-    # iterate over replace labels ( {{ ... }} )
-    matches = set([m for m in re.findall("{{ ?.*? ?}}", contents)])
-    for match in matches:
-        key = re.sub('^{{ ?| ?}}$', '', match)
-        item = filemap.get(key)
+    # write text in between labels as-is, replace labels by inserts
+    # i.e. no escaping requirements on the inserted contents
+    called = {}
+    position = 0
+    for match in LABEL_PATTERN.finditer(contents):
+        key = re.sub('^{{ ?| ?}}$', '', match.group())
+        # validate before writing anything of this label
+        chunks = insert_chunks(key, filemap.get(key), called)
+        output.write(contents[position:match.start()])
+        for chunk in chunks:
+            output.write(chunk)
+        position = match.end()
+    output.write(contents[position:])
+
 
+def inputs_hash(template, filemap):
+    """Return sha256 over the template, inserted files, constant values and
+    this script. Callable values (version and date stamps) are left out, these
+    are only bumped when the contents change"""
+    digest = hashlib.sha256()
+    paths = [template, os.path.abspath(__file__)]
+    for key, item in sorted(filemap.items()):
+        digest.update(f'{key}\0'.encode())
         if isinstance(item, str) and os.path.isfile(item):
-            # file contents to be inserted
-            with open(item, 'r') as stream:
-                insert = stream.read().strip()
-            # makefile requires $ to be escaped by $
-            insert = re.sub('\$', '$$', insert)
-        elif isinstance(item, str):
-            insert = item
-        elif isinstance(item, int):
-            insert = str(item)
-        elif hasattr(item, '__call__'):
-            insert = str(item())
-        else:
-            raise TypeError(f'Unsupported replacement type:{type(item)} for {key}')
+            paths.append(item)
+        elif isinstance(item, (str, int)):
+            digest.update(f'{item}\0'.encode())
+    for path in paths:
+        with open(path, 'rb') as stream:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
 
-        # use this file injection type method over re.sub to do genuine
-        # as-is type replacement -- i.e. no espacing requirements
-        position = re.search(re.escape(match), contents)
-        contents = contents[0:position.start()] + insert + contents[position.end():]
-    return contents
+def cache_read(path):
+    """Return the inputs hash cached for (generated) path, if any"""
+    try:
+        with open(f'{path}.cache', 'r') as stream:
+            return json.load(stream).get('InputsHash')
+    except (OSError, ValueError):
+        return None
+
+
+def cache_write(path, inputs_hash):
+    """Record the inputs hash of (generated) path"""
+    with open(f'{path}.cache', 'w') as stream:
+        json.dump({'InputsHash': inputs_hash}, stream)
+
+
+def is_current(path, inputs_hash):
+    """Check if path was generated from the same inputs"""
+    return os.path.isfile(path) and cache_read(path) == inputs_hash
+
+
+def generate_file(template, filemap, path):
+    """Generate makefile to path, replaced at once when complete"""
+    temporary_path = f'{path}.tmp'
+    try:
+        with open(temporary_path, 'w') as stream:
+            generate_makefile(template, filemap, stream)
+        os.replace(temporary_path, path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
 
 
 filemap = {
@@ -62,4 +149,28 @@ filemap = {
     'GIT_FUNCTIONS': 'src/git_functions.sh'
 }
 
-sys.stdout.write(generate_makefile('src/Makefile.template', filemap))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate Makefile from src/')
+    parser.add_argument(
+        '--output', help='write to file (replaced when complete), default: stdout')
+    parser.add_argument(
+        '--check', action='store_true',
+        help='exit 1 if --output is not generated from the current inputs')
+    args = parser.parse_args()
+    if args.check and not args.output:
+        parser.error('--check requires --output')
+
+    if args.output:
+        # unchanged inputs leave output (and its version stamps) untouched
+        inputs = inputs_hash('src/Makefile.template', filemap)
+        if is_current(args.output, inputs):
+            sys.stderr.write(f'{args.output} is up to date\n')
+        elif args.check:
+            sys.stderr.write(f'{args.output} is outdated\n')
+            sys.exit(1)
+        else:
+            generate_file('src/Makefile.template', filemap, args.output)
+            cache_write(args.output, inputs)
+    else:
+        generate_makefile('src/Makefile.template', filemap, sys.stdout)
@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+# --------------------------------------------------------------------
+# Copyright (c) 2020 Anthony Potappel - LINKIT, The Netherlands.
+# SPDX-License-Identifier: MIT
+# --------------------------------------------------------------------
+"""
+Benchmarks of the custom resource flows against the offline harness:
+wall-clock time, API call counts and per-invocation latency. Stubbed API
+calls take --latency seconds each, so concurrency shows up in the numbers.
+"""
+
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+import statistics
+import tracemalloc
+import subprocess
+import urllib.request
+
+from collections import defaultdict
+
+from harness import (
+    FUNCTIONS, SOURCE_DIRS, Harness, check_pipeline, cfn_response, ecr_create,
+    eventrule_waiter, pipeline_update, ssm_param_put
+)
+from replay import pipeline_stages
+
+
+def report(name, **metrics):
+    values = '  '.join(
+        f'{key}={value:.4f}' if isinstance(value, float) else f'{key}={value}'
+        for key, value in metrics.items()
+    )
+    print(f'{name:<36} {values}')
+
+
+def timed(function, *args):
+    """Return (result, seconds) of function(*args)"""
+    start_time = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start_time
+
+
+def bench_waiter(latency, probe_counts):
+    """Waiter with N Lambda probes (check_pipeline) until SUCCESS, on the
+    probe pool and on a single worker (serial baseline)"""
+    pool_workers = eventrule_waiter.PROBE_WORKERS
+    for count in probe_counts:
+        for workers in [1, pool_workers]:
+            eventrule_waiter.PROBE_WORKERS = workers
+            eventrule_waiter._probe_executor = None
+            try:
+                waiter_run(latency, count, workers)
+            finally:
+                eventrule_waiter.PROBE_WORKERS = pool_workers
+                eventrule_waiter._probe_executor = None
+
+
+def waiter_run(latency, count, workers):
+    """One waiter run, report per-tick latency and API calls"""
+    with Harness(latency=latency) as harness:
+        harness.codepipeline.add('harness-pipeline', pipeline_stages())
+        probes = [{
+            'Provider': 'Lambda',
+            'Properties': {
+                'ServiceToken': FUNCTIONS[check_pipeline],
+                'PipelineName': 'harness-pipeline',
+                'PipelineExecutionId': harness.codepipeline.start_pipeline_execution(
+                    name='harness-pipeline')['pipelineExecutionId']
+            }
+        } for _ in range(count)]
+        harness.recorder.reset()
+
+        event = harness.event(
+            'Create', {'TimeoutInMinutes': '20', 'Probes': probes},
+            module=eventrule_waiter, logical_id='Waiter')
+        latencies = [timed(harness.invoke, eventrule_waiter, event)[1]]
+        while harness.response(event) is None and len(latencies) < 10:
+            latencies.append(timed(harness.tick)[1])
+
+        response = harness.response(event) or {'Status': 'NONE'}
+        report(
+            f'waiter probes={count} workers={workers}',
+            status=response['Status'],
+            ticks=len(latencies),
+            tick_mean_s=statistics.mean(latencies),
+            tick_max_s=max(latencies),
+            api_calls=harness.recorder.total(),
+            invokes=harness.recorder.calls[('lambda', 'Invoke')]
+        )
+
+
+def bench_ecr(latency, count):
+    """Create, reconcile (10% changed) and delete N repositories"""
+    names = [f'image-{idx}' for idx in range(count)]
+    changed = names[count // 10:] + [f'new-{idx}' for idx in range(count // 10)]
+    with Harness(latency=latency) as harness:
+        old_properties = None
+        for request_type, paths in [
+                ('Create', names), ('Update', changed), ('Delete', changed)]:
+            properties = {'EnvironmentName': 'Dev', 'RepositoryPathList': ','.join(paths)}
+            event = harness.event(
+                request_type, properties, module=ecr_create, old_properties=old_properties)
+            harness.recorder.reset()
+            _, seconds = timed(harness.invoke, ecr_create, event)
+            report(
+                f'ecr {request_type.lower()} n={count}',
+                status=harness.response(event)['Status'],
+                seconds=seconds,
+                api_calls=harness.recorder.total()
+            )
+            old_properties = properties
+
+
+def bench_ssm(latency, count):
+    """Create, re-apply unchanged, and delete N parameters"""
+    parameters = {f'/bench/param-{idx}': str(idx) for idx in range(count)}
+    with Harness(latency=latency) as harness:
+        for name, request_type in [
+                ('create', 'Create'), ('update unchanged', 'Update'), ('delete', 'Delete')]:
+            properties = {'Parameters': parameters}
+            event = harness.event(
+                request_type, properties, module=ssm_param_put, old_properties=properties)
+            harness.recorder.reset()
+            _, seconds = timed(harness.invoke, ssm_param_put, event)
+            report(
+                f'ssm {name} n={count}',
+                status=harness.response(event)['Status'],
+                seconds=seconds,
+                api_calls=harness.recorder.total(),
+                writes=harness.recorder.calls[('ssm', 'PutParameter')]
+            )
+
+
+def pipeline_properties(count):
+    """PipelineUpdate properties with a build action mapped to N actions"""
+    names = ','.join(f'image-{idx}' for idx in range(count))
+    return {
+        'Target': 'harness-pipeline',
+        'ExecutePipeline': 'true',
+        'Stages': [{
+            'StageOrder': '1',
+            'StageDeclaration': {
+                'Name': 'Build',
+                'Actions': [{
+                    'Name': 'Build',
+                    'ActionTypeId': {
+                        'Category': 'Build', 'Owner': 'AWS',
+                        'Provider': 'CodeBuild', 'Version': '1'
+                    },
+                    'Configuration': {
+                        'ProjectName': 'bench',
+                        'EnvironmentVariables': [
+                            {'Name': 'STAGE', 'Value': 'dev', 'Type': 'PLAINTEXT'}
+                        ]
+                    },
+                    'InputArtifacts': [{'Name': 'Source'}],
+                    'OutputArtifacts': [{'Name': 'Image'}]
+                }]
+            },
+            'MapConfig': [{
+                'SourceAction': 'Build',
+                'EnvironmentVariables': {'IMAGE': names, 'PATH': names},
+                'NameList': names
+            }]
+        }]
+    }
+
+
+def bench_pipeline(latency, count):
+    """Create and no-op Update of a pipeline with N mapped actions"""
+    properties = pipeline_properties(count)
+    with Harness(latency=latency) as harness:
+        harness.codepipeline.add('harness-pipeline', pipeline_stages())
+        for request_type in ['Create', 'Update']:
+            event = harness.event(
+                request_type, properties, module=pipeline_update, old_properties=properties)
+            harness.recorder.reset()
+            _, seconds = timed(harness.invoke, pipeline_update, event)
+            response = harness.response(event)
+            report(
+                f'pipeline {request_type.lower()} n={count}',
+                status=response['Status'],
+                seconds=seconds,
+                api_calls=harness.recorder.total(),
+                changed=response['Data'].get('PipelineChanged')
+            )
+
+
+def mapper_reference(template, config):
+    """mapper() as it was before the shared-parts fan-out (deep copy per
+    mapped action), kept for comparison"""
+    template['configuration'] = pipeline_update.change_dictkeys(
+        template['configuration'], lambda k: k[:1].upper() + k[1:])
+    template['runOrder'] = int(template.get('runOrder', 1))
+    if template['name'] not in config:
+        return [template]
+
+    _map = defaultdict(list)
+    for key, vlist in config[template['name']]['EnvironmentVariables'].items():
+        for y, val in enumerate(vlist.split(',')):
+            _map[y].append({'name': key, 'value': val, 'type': 'PLAINTEXT'})
+    envvars = pipeline_update.change_dictkeys(
+        template['configuration'].get('EnvironmentVariables', '[]'),
+        lambda k: k[:1].lower() + k[1:]
+    )
+    if envvars:
+        _map = {k: v + envvars for k, v in _map.items()}
+
+    actions = [copy.deepcopy(template) for _ in _map.keys()]
+    namelist = [
+        pipeline_update.trim_alphanum(name)
+        for name in config[template['name']]['NameList'].split(',')
+    ]
+    for idx, varstr in enumerate([
+        json.dumps(v, separators=(',', ':')) for _, v in sorted(_map.items())
+    ]):
+        actions[idx]['name'] = namelist[idx]
+        actions[idx]['configuration']['EnvironmentVariables'] = varstr
+        output_list = actions[idx].get('outputArtifacts')
+        if output_list:
+            actions[idx]['outputArtifacts'] = [
+                {'name': pipeline_update.trim_alphanum(f"{output['name']}-{namelist[idx]}")}
+                for output in output_list
+            ]
+    return actions
+
+
+def peak_memory(function, *args):
+    """Return peak (traced) memory allocated by function(*args), in bytes"""
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_mapper(counts, repeat):
+    """mapper() against the deep copy reference for N mapped actions, time
+    and peak memory"""
+    for count in counts:
+        stage = pipeline_properties(count)['Stages'][0]
+        template = pipeline_update.change_dictkeys(
+            stage['StageDeclaration']['Actions'][0], lambda k: k[:1].lower() + k[1:])
+        config = {'Build': {
+            'EnvironmentVariables': stage['MapConfig'][0]['EnvironmentVariables'],
+            'NameList': stage['MapConfig'][0]['NameList']
+        }}
+        results = {}
+        memory = {}
+        for name, function in [
+                ('reference', mapper_reference), ('mapper', pipeline_update.mapper)]:
+            seconds = min(
+                timed(function, copy.deepcopy(template), config)[1] for _ in range(repeat))
+            results[name] = seconds
+            memory[name] = peak_memory(function, copy.deepcopy(template), config)
+        expected = mapper_reference(copy.deepcopy(template), config)
+        report(
+            f'mapper n={count}',
+            reference_s=results['reference'],
+            mapper_s=results['mapper'],
+            speedup=results['reference'] / results['mapper'],
+            reference_kb=memory['reference'] // 1024,
+            mapper_kb=memory['mapper'] // 1024,
+            identical=pipeline_update.mapper(copy.deepcopy(template), config) == expected
+        )
+
+
+def send_reference(event, context, response_status, response_data):
+    """cfn_response.send as it was before the shared module (a urllib PUT on
+    a new connection, per Lambda), kept for comparison"""
+    response_body = json.dumps({
+        'Status': response_status,
+        'Reason': f'See the details in CloudWatch Log Stream: {context.log_group_name}',
+        'PhysicalResourceId': context.log_stream_name,
+        'StackId': event['StackId'],
+        'RequestId': event['RequestId'],
+        'LogicalResourceId': event['LogicalResourceId'],
+        'NoEcho': False,
+        'Data': response_data
+    })
+    request = urllib.request.Request(
+        event['ResponseURL'],
+        data=response_body.encode(),
+        headers={'content-type': '', 'content-length': str(len(response_body))},
+        method='PUT'
+    )
+    with urllib.request.urlopen(request) as response:
+        return response.getcode()
+
+
+def bench_cfn_response(count):
+    """cfn_response.send to the local ResponseURL, with and without
+    connection re-use, and the urllib reference"""
+    with Harness() as harness:
+        # the real transport, ResponseURL points at the local server
+        cfn_response.connection = harness._connection
+        context = type('Context', (), {
+            'log_stream_name': 'bench', 'log_group_name': 'bench'})()
+        for name, reuse in [
+                ('keep-alive', True), ('new connection', False), ('urllib reference', None)]:
+            latencies = []
+            for idx in range(count):
+                event = harness.event('Create', {}, logical_id='Bench')
+                if reuse is None:
+                    latencies.append(timed(
+                        send_reference, event, context, 'SUCCESS', {'Index': idx})[1])
+                    continue
+                if not reuse:
+                    for conn in cfn_response._connections.values():
+                        conn.close()
+                    cfn_response._connections.clear()
+                latencies.append(timed(
+                    cfn_response.send, event, context, 'SUCCESS', {'Index': idx})[1])
+            report(
+                f'cfn_response {name}',
+                sends=count,
+                mean_ms=statistics.mean(latencies) * 1000,
+                p95_ms=sorted(latencies)[int(count * 0.95) - 1] * 1000
+            )
+        for conn in cfn_response._connections.values():
+            conn.close()
+
+
+def import_times(name):
+    """Return {module: (self_us, cumulative_us, depth)} of a cold import of
+    module name, as reported by python -X importtime"""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(SOURCE_DIRS))
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {name}'],
+        env=env, capture_output=True, text=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        depth = (len(module) - len(module.lstrip())) // 2
+        times[module.strip()] = (int(self_us), int(cumulative_us), depth)
+    return times
+
+
+def bench_import(repeat):
+    """Cold import time of each module (python -X importtime), the heaviest
+    direct dependency and whether boto3 is loaded at import"""
+    for module in FUNCTIONS.keys():
+        name = module.__name__
+        runs = [import_times(name) for _ in range(repeat)]
+        times = min(runs, key=lambda item: item[name][1])
+        heaviest = max(
+            [(value[1], key) for key, value in times.items() if value[2] == 1 and key != name],
+            default=(0, '-'))
+        report(
+            f'import {name}',
+            cumulative_ms=times[name][1] / 1000,
+            modules=len(times),
+            heaviest=f'{heaviest[1]}:{heaviest[0] / 1000:.1f}ms',
+            boto3_loaded='boto3' in times
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='simulated latency of each stubbed API call (seconds)')
+    parser.add_argument('--quick', action='store_true', help='smaller sizes, fewer repeats')
+    args = parser.parse_args()
+
+    repeat = 1 if args.quick else 5
+    bench_waiter(args.latency, [1, 10] if args.quick else [1, 10, 50])
+    bench_ecr(args.latency, 20 if args.quick else 100)
+    bench_ssm(args.latency, 10 if args.quick else 50)
+    bench_pipeline(args.latency, 10 if args.quick else 100)
+    bench_mapper([10, 100] if args.quick else [10, 100, 1000], repeat)
+    bench_cfn_response(20 if args.quick else 200)
+    bench_import(repeat)
+
+
+if __name__ == '__main__':
+    main()
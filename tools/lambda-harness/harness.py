@@ -0,0 +1,735 @@
+#!/usr/bin/env python3
+# --------------------------------------------------------------------
+# Copyright (c) 2020 Anthony Potappel - LINKIT, The Netherlands.
+# SPDX-License-Identifier: MIT
+# --------------------------------------------------------------------
+"""
+Offline harness for the custom resource Lambdas in Webhosting/Classic.
+
+Handlers run in-process against stubbed AWS clients (injected through
+aws_clients.register) and an in-process HTTP server that stands in for the
+CloudFormation ResponseURL (PUT) and S3 presigned POST endpoints. Uploaded
+probe results land in the S3 stub, so waiter flows run end-to-end.
+"""
+
+import io
+import os
+import re
+import sys
+import copy
+import json
+import time
+import uuid
+import bisect
+import hashlib
+import itertools
+import threading
+import collections
+import http.client
+import http.server
+
+
+SOURCE_DIRS = [
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../Webhosting/Classic', path)
+    for path in ['WaiterLambda/src', 'ContainerBuild/src']
+]
+sys.path[0:0] = [path for path in SOURCE_DIRS if path not in sys.path]
+
+# modules both CodeUri roots ship; they must stay byte-identical
+SHARED_MODULES = ['cfn_response.py', 'aws_clients.py']
+
+os.environ.setdefault('S3BucketArn', 'arn:aws:s3:::harness-waiter-bucket')
+os.environ.setdefault('S3BucketPrefix', 'harness')
+
+import aws_clients
+import cfn_response
+import check_pipeline
+import ecr_create
+import empty_bucket
+import eventrule_waiter
+import pipeline_update
+import ssm_param_put
+
+
+ACCOUNT_ARN = 'arn:aws:lambda:eu-west-1:123456789012:function'
+
+# {module: function arn} of the Lambdas registered in the Lambda stub
+FUNCTIONS = {
+    eventrule_waiter: f'{ACCOUNT_ARN}:WaiterLambda',
+    empty_bucket: f'{ACCOUNT_ARN}:EmptyBucketLambda',
+    check_pipeline: f'{ACCOUNT_ARN}:CheckPipelineLambda',
+    ecr_create: f'{ACCOUNT_ARN}:EcrCreateLambda',
+    pipeline_update: f'{ACCOUNT_ARN}:PipelineUpdateLambda',
+    ssm_param_put: f'{ACCOUNT_ARN}:SsmParamPutLambda'
+}
+
+STACK_ID = 'arn:aws:cloudformation:eu-west-1:123456789012:stack/harness/' \
+    '00000000-0000-0000-0000-000000000000'
+
+
+class Context:
+    """Lambda context stand-in"""
+    def __init__(self, function_arn, timeout=60):
+        self.invoked_function_arn = function_arn
+        self.function_name = function_arn.split(':')[-1]
+        self.log_group_name = f'/aws/lambda/{self.function_name}'
+        self.log_stream_name = f'2020/01/01/[$LATEST]{uuid.uuid4().hex}'
+        self._end_time = time.time() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self._end_time - time.time()) * 1000))
+
+
+class Recorder:
+    """Count API calls per (service, operation), add simulated latency"""
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = collections.Counter()
+        self._lock = threading.Lock()
+
+    def __call__(self, service, operation):
+        with self._lock:
+            self.calls[(service, operation)] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def total(self, service=None):
+        return sum(
+            count for (name, _), count in self.calls.items()
+            if service is None or name == service
+        )
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+
+
+class ClientError(Exception):
+    """Modelled (botocore) client exception, message is '<Code>: <text>'"""
+    def __init__(self, message):
+        super().__init__(message)
+        self.response = {'Error': {'Code': message.split(':')[0], 'Message': message}}
+
+
+def exceptions(*names):
+    """Namespace of exception classes, like client.exceptions"""
+    return type('Exceptions', (), {name: type(name, (ClientError,), {}) for name in names})
+
+
+class Paginator:
+    """Paginator stand-in, stub operations return everything in one page"""
+    def __init__(self, operation):
+        self.operation = operation
+
+    def paginate(self, **kwargs):
+        kwargs.pop('PaginationConfig', None)
+        yield self.operation(**kwargs)
+
+
+class Stub:
+    """Base of the client stubs, records each operation call"""
+    service = ''
+    exceptions = exceptions()
+
+    def __init__(self, recorder):
+        self.recorder = recorder
+        self._lock = threading.RLock()
+
+    def _call(self, operation):
+        self.recorder(self.service, operation)
+
+    def get_paginator(self, operation):
+        return Paginator(getattr(self, operation))
+
+
+class S3Stub(Stub):
+    service = 's3'
+
+    def __init__(self, recorder):
+        super().__init__(recorder)
+        # {bucket: {key: body}}
+        self.buckets = collections.defaultdict(dict)
+        self.lifecycle = {}
+        self._sorted = {}
+
+    def put(self, bucket, key, body):
+        with self._lock:
+            self.buckets[bucket][key] = body
+            self._sorted.pop(bucket, None)
+
+    def sorted_keys(self, bucket):
+        with self._lock:
+            if bucket not in self._sorted:
+                self._sorted[bucket] = sorted(self.buckets[bucket])
+            return self._sorted[bucket]
+
+    @staticmethod
+    def etag(body):
+        return f'"{hashlib.md5(body).hexdigest()}"'
+
+    def get_bucket_location(self, Bucket):
+        self._call('GetBucketLocation')
+        return {'LocationConstraint': 'eu-west-1'}
+
+    def generate_presigned_post(self, Bucket, Key, ExpiresIn=3600):
+        # local operation, no API call
+        return {
+            'url': f'https://{Bucket}.s3.amazonaws.com/',
+            'fields': {'key': Key, 'bucket': Bucket, 'policy': 'harness'}
+        }
+
+    def put_object(self, Bucket, Key, Body):
+        self._call('PutObject')
+        self.put(Bucket, Key, Body if isinstance(Body, bytes) else Body.encode())
+        return {'ETag': self.etag(self.buckets[Bucket][Key])}
+
+    def get_object(self, Bucket, Key, IfMatch=None):
+        self._call('GetObject')
+        body = self.buckets[Bucket].get(Key)
+        if body is None:
+            raise ClientError(f'NoSuchKey: {Key}')
+        if IfMatch is not None and IfMatch != self.etag(body):
+            raise ClientError(f'PreconditionFailed: {Key}')
+        return {'Body': io.BytesIO(body), 'ETag': self.etag(body)}
+
+    def delete_object(self, Bucket, Key):
+        self._call('DeleteObject')
+        with self._lock:
+            self.buckets[Bucket].pop(Key, None)
+            self._sorted.pop(Bucket, None)
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix=''):
+        self._call('ListObjectsV2')
+        with self._lock:
+            items = list(self.buckets[Bucket].items())
+        return {'Contents': [
+            {'Key': key, 'ETag': self.etag(body)}
+            for key, body in items if key.startswith(Prefix)
+        ]}
+
+    def list_object_versions(self, Bucket, Prefix='', Delimiter=None, KeyMarker='',
+                             VersionIdMarker=None, MaxKeys=1000):
+        self._call('ListObjectVersions')
+        keys = self.sorted_keys(Bucket)
+        start = max(bisect.bisect_left(keys, Prefix), bisect.bisect_right(keys, KeyMarker))
+        versions, prefixes = [], []
+        for key in itertools.islice(keys, start, None):
+            if not key.startswith(Prefix):
+                break
+            rest = key[len(Prefix):]
+            if Delimiter and Delimiter in rest:
+                prefix = Prefix + rest.split(Delimiter)[0] + Delimiter
+                if prefix not in prefixes:
+                    prefixes.append(prefix)
+                continue
+            if len(versions) == MaxKeys:
+                return {
+                    'Versions': versions, 'CommonPrefixes': [{'Prefix': p} for p in prefixes],
+                    'IsTruncated': True,
+                    'NextKeyMarker': versions[-1]['Key'], 'NextVersionIdMarker': 'null'
+                }
+            versions.append({'Key': key, 'VersionId': 'null'})
+        return {
+            'Versions': versions, 'CommonPrefixes': [{'Prefix': p} for p in prefixes],
+            'IsTruncated': False
+        }
+
+    def delete_objects(self, Bucket, Delete):
+        self._call('DeleteObjects')
+        with self._lock:
+            for item in Delete['Objects']:
+                self.buckets[Bucket].pop(item['Key'], None)
+            self._sorted.pop(Bucket, None)
+        return {}
+
+    def put_bucket_lifecycle_configuration(self, Bucket, LifecycleConfiguration):
+        self._call('PutBucketLifecycleConfiguration')
+        self.lifecycle[Bucket] = LifecycleConfiguration
+        return {}
+
+
+class CloudWatchStub(Stub):
+    service = 'cloudwatch'
+
+    def __init__(self, recorder, s3):
+        super().__init__(recorder)
+        self.s3 = s3
+        # set to model a role without cloudwatch:GetMetricStatistics
+        self.denied = False
+
+    def get_metric_statistics(self, Namespace, MetricName, Dimensions, **kwargs):
+        self._call('GetMetricStatistics')
+        if self.denied:
+            raise ClientError('AccessDenied: cloudwatch:GetMetricStatistics')
+        bucket = [item['Value'] for item in Dimensions if item['Name'] == 'BucketName'][0]
+        # older (daily) datapoint of a larger bucket is not the current state
+        return {'Datapoints': [
+            {'Timestamp': 1, 'Average': float(len(self.s3.buckets[bucket]))},
+            {'Timestamp': 0, 'Average': float(len(self.s3.buckets[bucket]) * 10)}
+        ]}
+
+
+class EventsStub(Stub):
+    service = 'events'
+    exceptions = exceptions('ResourceNotFoundException')
+
+    def __init__(self, recorder):
+        super().__init__(recorder)
+        # {name: {'State':, 'ScheduleExpression'|'EventPattern':, 'Targets': {id: target}}}
+        self.rules = {}
+
+    def _rule(self, name):
+        if name not in self.rules:
+            raise self.exceptions.ResourceNotFoundException(f'Rule {name} does not exist')
+        return self.rules[name]
+
+    def put_rule(self, Name, State='ENABLED', **kwargs):
+        self._call('PutRule')
+        with self._lock:
+            rule = self.rules.setdefault(Name, {'Targets': {}})
+            rule.update(kwargs, State=State)
+        return {'RuleArn': f'arn:aws:events:eu-west-1:123456789012:rule/{Name}'}
+
+    def describe_rule(self, Name):
+        self._call('DescribeRule')
+        return dict(self._rule(Name), Name=Name)
+
+    def put_targets(self, Rule, Targets):
+        self._call('PutTargets')
+        for target in Targets:
+            if 'Input' in target and len(target['Input']) > 8192:
+                raise ClientError('ValidationException: Input exceeds 8192 characters')
+            self._rule(Rule)['Targets'][target['Id']] = target
+        return {'FailedEntryCount': 0}
+
+    def list_targets_by_rule(self, Rule, Limit=100):
+        self._call('ListTargetsByRule')
+        return {'Targets': list(self._rule(Rule)['Targets'].values())[:Limit]}
+
+    def remove_targets(self, Rule, Ids):
+        self._call('RemoveTargets')
+        for target_id in Ids:
+            self._rule(Rule)['Targets'].pop(target_id, None)
+        return {}
+
+    def delete_rule(self, Name):
+        self._call('DeleteRule')
+        self._rule(Name)
+        del self.rules[Name]
+        return {}
+
+    def scheduled(self):
+        """Return [(function arn, input)] of enabled scheduled targets"""
+        with self._lock:
+            return [
+                (target['Arn'], json.loads(target['Input']))
+                for rule in self.rules.values()
+                if rule.get('ScheduleExpression') and rule['State'] == 'ENABLED'
+                for target in rule['Targets'].values()
+            ]
+
+
+class LambdaStub(Stub):
+    service = 'lambda'
+
+    def __init__(self, recorder):
+        super().__init__(recorder)
+        # {function arn: (handler, timeout)}
+        self.functions = {}
+        self.threads = []
+
+    def add(self, function_arn, handler, timeout=60):
+        self.functions[function_arn] = (handler, timeout)
+
+    def run(self, function_arn, event):
+        handler, timeout = self.functions[function_arn]
+        return handler(event, Context(function_arn, timeout))
+
+    def invoke(self, FunctionName, Payload, InvocationType='RequestResponse', LogType='None'):
+        self._call('Invoke')
+        event = json.loads(Payload)
+        if InvocationType == 'Event':
+            thread = threading.Thread(target=self.run, args=(FunctionName, event), daemon=True)
+            with self._lock:
+                self.threads.append(thread)
+            thread.start()
+            return {'StatusCode': 202}
+        return {
+            'StatusCode': 200,
+            'Payload': io.BytesIO(json.dumps(self.run(FunctionName, event)).encode())
+        }
+
+    def drain(self):
+        """Wait for all asynchronous invocations, including nested ones"""
+        while True:
+            with self._lock:
+                threads, self.threads = self.threads, []
+            if not threads:
+                return
+            for thread in threads:
+                thread.join()
+
+
+class CodePipelineStub(Stub):
+    service = 'codepipeline'
+
+    def __init__(self, recorder, succeed_after=1):
+        super().__init__(recorder)
+        self.pipelines = {}
+        # {execution_id: [pipeline name, status, status checks]}
+        self.executions = collections.OrderedDict()
+        self.succeed_after = succeed_after
+
+    def add(self, name, stages):
+        self.pipelines[name] = {'name': name, 'version': 1, 'stages': stages}
+
+    def get_pipeline(self, name):
+        self._call('GetPipeline')
+        return {'pipeline': copy.deepcopy(self.pipelines[name]), 'metadata': {}}
+
+    def update_pipeline(self, pipeline):
+        self._call('UpdatePipeline')
+        pipeline = dict(copy.deepcopy(pipeline), version=pipeline.get('version', 0) + 1)
+        self.pipelines[pipeline['name']] = pipeline
+        return {'pipeline': copy.deepcopy(pipeline)}
+
+    def enable_stage_transition(self, pipelineName, stageName, transitionType):
+        self._call('EnableStageTransition')
+        return {}
+
+    def start_pipeline_execution(self, name):
+        self._call('StartPipelineExecution')
+        execution_id = str(uuid.uuid4())
+        self.executions[execution_id] = [name, 'InProgress', 0]
+        return {'pipelineExecutionId': execution_id}
+
+    def _status(self, execution_id):
+        execution = self.executions[execution_id]
+        execution[2] += 1
+        if execution[1] == 'InProgress' and execution[2] > self.succeed_after:
+            execution[1] = 'Succeeded'
+        return execution[1]
+
+    def get_pipeline_execution(self, pipelineName, pipelineExecutionId):
+        self._call('GetPipelineExecution')
+        return {'pipelineExecution': {
+            'pipelineName': pipelineName,
+            'pipelineExecutionId': pipelineExecutionId,
+            'status': self._status(pipelineExecutionId)
+        }}
+
+    def list_pipeline_executions(self, pipelineName, maxResults=100):
+        self._call('ListPipelineExecutions')
+        executions = [
+            execution_id for execution_id, execution in reversed(self.executions.items())
+            if execution[0] == pipelineName
+        ][:maxResults]
+        return {'pipelineExecutionSummaries': [
+            {'pipelineExecutionId': execution_id, 'status': self._status(execution_id)}
+            for execution_id in executions
+        ]}
+
+    def get_pipeline_state(self, name):
+        self._call('GetPipelineState')
+        return {'stageStates': [
+            {'stageName': stage['name']} for stage in self.pipelines[name]['stages']
+        ]}
+
+
+class EcsStub(Stub):
+    service = 'ecs'
+
+    def __init__(self, recorder):
+        super().__init__(recorder)
+        # {(cluster, name): description}
+        self.services = {}
+
+    def add(self, cluster, name, desired=1, running=1, rollout='COMPLETED'):
+        self.services[(cluster, name)] = {
+            'serviceName': name,
+            'serviceArn': f'arn:aws:ecs:eu-west-1:123456789012:service/{cluster}/{name}',
+            'status': 'ACTIVE',
+            'desiredCount': desired,
+            'runningCount': running,
+            'deployments': [{
+                'status': 'PRIMARY', 'rolloutState': rollout,
+                'desiredCount': desired, 'runningCount': running
+            }]
+        }
+
+    def describe_services(self, cluster, services):
+        self._call('DescribeServices')
+        if len(services) > 10:
+            raise ClientError('InvalidParameterException: max 10 services per call')
+        if not [key for key in self.services if key[0] == cluster]:
+            raise ClientError(f'ClusterNotFoundException: {cluster}')
+        return {
+            'services': [
+                self.services[(cluster, name)]
+                for name in services if (cluster, name) in self.services
+            ],
+            'failures': [
+                {'arn': name, 'reason': 'MISSING'}
+                for name in services if (cluster, name) not in self.services
+            ]
+        }
+
+
+class EcrStub(Stub):
+    service = 'ecr'
+    exceptions = exceptions(
+        'RepositoryAlreadyExistsException', 'RepositoryNotFoundException')
+
+    def __init__(self, recorder):
+        super().__init__(recorder)
+        self.repositories = set()
+
+    def describe_repositories(self):
+        self._call('DescribeRepositories')
+        return {'repositories': [
+            {'repositoryName': name} for name in sorted(self.repositories)
+        ]}
+
+    def create_repository(self, repositoryName, **kwargs):
+        self._call('CreateRepository')
+        with self._lock:
+            if repositoryName in self.repositories:
+                raise self.exceptions.RepositoryAlreadyExistsException(repositoryName)
+            self.repositories.add(repositoryName)
+        return {'repository': {'repositoryName': repositoryName}}
+
+    def delete_repository(self, repositoryName, force=False):
+        self._call('DeleteRepository')
+        with self._lock:
+            if repositoryName not in self.repositories:
+                raise self.exceptions.RepositoryNotFoundException(repositoryName)
+            self.repositories.discard(repositoryName)
+        return {'repository': {'repositoryName': repositoryName}}
+
+
+class SsmStub(Stub):
+    service = 'ssm'
+
+    def __init__(self, recorder):
+        super().__init__(recorder)
+        self.parameters = {}
+
+    def put_parameter(self, Name, Value, **kwargs):
+        self._call('PutParameter')
+        self.parameters[Name] = Value
+        return {'Version': 1}
+
+    def get_parameters(self, Names):
+        self._call('GetParameters')
+        if len(Names) > 10:
+            raise ClientError('ValidationException: max 10 names per call')
+        return {
+            'Parameters': [
+                {'Name': name, 'Value': self.parameters[name]}
+                for name in Names if name in self.parameters
+            ],
+            'InvalidParameters': [name for name in Names if name not in self.parameters]
+        }
+
+    def delete_parameters(self, Names):
+        self._call('DeleteParameters')
+        if len(Names) > 10:
+            raise ClientError('ValidationException: max 10 names per call')
+        deleted = [name for name in Names if self.parameters.pop(name, None) is not None]
+        return {
+            'DeletedParameters': deleted,
+            'InvalidParameters': [name for name in Names if name not in deleted]
+        }
+
+
+def multipart_fields(content_type, body):
+    """Return {name: bytes} of a multipart/form-data body"""
+    boundary = re.search('boundary=(.*)', content_type).group(1).encode()
+    fields = {}
+    for part in body.split(b'--' + boundary):
+        if b'\r\n\r\n' not in part:
+            continue
+        headers, value = part.split(b'\r\n\r\n', 1)
+        name = re.search(rb'name="([^"]*)"', headers)
+        if name:
+            fields[name.group(1).decode()] = value[:-2] if value.endswith(b'\r\n') else value
+    return fields
+
+
+class ResponseServer:
+    """In-process stand-in for the CloudFormation ResponseURL (PUT) and the
+    S3 presigned POST (uploads are stored in the S3 stub). GET requests are
+    answered with health_status, a target for Http and Tcp probes"""
+    def __init__(self, s3):
+        self.s3 = s3
+        self.health_status = 200
+        # {path: [response]} of CloudFormation responses
+        self.responses = collections.defaultdict(list)
+        self.requests = collections.Counter()
+        self._condition = threading.Condition()
+        self._connections = {}
+
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_PUT(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                with server._condition:
+                    server.requests['PUT'] += 1
+                    server.responses[self.path].append(json.loads(body))
+                    server._condition.notify_all()
+                self.reply(200)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                fields = multipart_fields(self.headers['Content-Type'], body)
+                server.s3.put(
+                    fields['bucket'].decode(), fields['key'].decode(), fields['file'])
+                with server._condition:
+                    server.requests['POST'] += 1
+                    server._condition.notify_all()
+                self.reply(204)
+
+            def do_GET(self):
+                self.reply(server.health_status)
+
+            def reply(self, status):
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        threading.Thread(
+            target=self.httpd.serve_forever, kwargs={'poll_interval': 0.01}, daemon=True
+        ).start()
+
+    def health_url(self):
+        return f'http://127.0.0.1:{self.port}/health'
+
+    def response_url(self, name):
+        return f'http://127.0.0.1:{self.port}/cloudformation/{name}'
+
+    def connection(self, scheme, host):
+        """Transport for cfn_response -- every host is served locally, so the
+        (regional) S3 presigned URLs end up here as well"""
+        if (scheme, host) not in self._connections:
+            self._connections[(scheme, host)] = http.client.HTTPConnection(
+                '127.0.0.1', self.port, timeout=cfn_response.REQUEST_TIMEOUT_SECONDS)
+        return self._connections[(scheme, host)]
+
+    def response(self, response_url, timeout=0):
+        """Return the (first) CloudFormation response sent to response_url"""
+        path = '/' + response_url.split('/', 3)[3]
+        with self._condition:
+            self._condition.wait_for(lambda: self.responses[path], timeout=timeout)
+            return (self.responses[path] or [None])[0]
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        for conn in self._connections.values():
+            conn.close()
+
+
+def reset_module_state():
+    """Forget caches kept by the modules in (warm) containers"""
+    aws_clients._clients.clear()
+    aws_clients._registered.clear()
+    cfn_response._connections.clear()
+    eventrule_waiter._fetch_cache.clear()
+    eventrule_waiter._region_cache.clear()
+    eventrule_waiter._presigned_cache.clear()
+    check_pipeline._push_registered.clear()
+
+
+class Harness:
+    """Stubbed AWS account with all custom resource Lambdas registered"""
+    def __init__(self, latency=0.0, succeed_after=1):
+        reset_module_state()
+        self.recorder = Recorder(latency)
+        self.s3 = S3Stub(self.recorder)
+        self.events = EventsStub(self.recorder)
+        self.lambda_ = LambdaStub(self.recorder)
+        self.codepipeline = CodePipelineStub(self.recorder, succeed_after=succeed_after)
+        self.ecr = EcrStub(self.recorder)
+        self.ecs = EcsStub(self.recorder)
+        self.ssm = SsmStub(self.recorder)
+        self.cloudwatch = CloudWatchStub(self.recorder, self.s3)
+        for stub in [self.s3, self.events, self.lambda_, self.codepipeline,
+                     self.ecr, self.ecs, self.ssm, self.cloudwatch]:
+            aws_clients.register(stub.service, stub)
+
+        self.server = ResponseServer(self.s3)
+        self._connection = cfn_response.connection
+        cfn_response.connection = self.server.connection
+
+        for module, function_arn in FUNCTIONS.items():
+            self.lambda_.add(function_arn, module.handler, timeout=59)
+
+    def close(self):
+        self.lambda_.drain()
+        cfn_response.connection = self._connection
+        self.server.close()
+        reset_module_state()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def event(self, request_type, properties, module=None, logical_id='Resource',
+              old_properties=None, physical_id=None):
+        """Compose a CloudFormation custom resource event"""
+        request_id = str(uuid.uuid4())
+        event = {
+            'RequestType': request_type,
+            'ResponseURL': self.server.response_url(request_id),
+            'StackId': STACK_ID,
+            'RequestId': request_id,
+            'ResourceType': f'Custom::{logical_id}',
+            'LogicalResourceId': logical_id,
+            'ResourceProperties': dict(properties)
+        }
+        if module is not None:
+            event['ResourceProperties']['ServiceToken'] = FUNCTIONS[module]
+        if old_properties is not None:
+            event['OldResourceProperties'] = dict(old_properties)
+        if physical_id is not None:
+            event['PhysicalResourceId'] = physical_id
+        return event
+
+    def invoke(self, module, event):
+        """Run handler of module (synchronous), return its return value"""
+        return self.lambda_.run(FUNCTIONS[module], event)
+
+    def response(self, event, timeout=0):
+        """Return the CloudFormation response to event, None if not sent"""
+        return self.server.response(event['ResponseURL'], timeout=timeout)
+
+    def tick(self):
+        """One scheduled round: run every enabled eventrule target once"""
+        self.lambda_.drain()
+        for function_arn, event in self.events.scheduled():
+            self.lambda_.run(function_arn, event)
+        self.lambda_.drain()
+
+    def until_response(self, event, max_ticks=10, between_ticks=None):
+        """Tick eventrules until event is responded to, return (response, ticks)"""
+        for ticks in range(max_ticks + 1):
+            self.lambda_.drain()
+            response = self.response(event)
+            if response is not None:
+                return response, ticks
+            if between_ticks:
+                between_ticks()
+            self.tick()
+        return self.response(event), max_ticks
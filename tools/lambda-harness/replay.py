@@ -0,0 +1,625 @@
+#!/usr/bin/env python3
+# --------------------------------------------------------------------
+# Copyright (c) 2020 Anthony Potappel - LINKIT, The Netherlands.
+# SPDX-License-Identifier: MIT
+# --------------------------------------------------------------------
+"""
+Replay Create/Update/Delete events into handler() of every custom resource
+Lambda, against the offline harness. Exits 1 if any scenario fails.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import threading
+import traceback
+
+from harness import (
+    FUNCTIONS, SHARED_MODULES, SOURCE_DIRS, ClientError, Harness, cfn_response,
+    check_pipeline, ecr_create, empty_bucket, eventrule_waiter, pipeline_update,
+    ssm_param_put
+)
+
+
+class ScenarioError(Exception):
+    pass
+
+
+def expect(condition, message):
+    if not condition:
+        raise ScenarioError(message)
+
+
+def expect_status(harness, event, status='SUCCESS', timeout=5):
+    """Check the CloudFormation response to event, return its Data"""
+    response = harness.response(event, timeout=timeout)
+    expect(response is not None, f"no response to {event['RequestType']}")
+    expect(
+        response['Status'] == status,
+        f"{event['RequestType']}: {response['Status']} {json.dumps(response['Data'])}"
+    )
+    return response['Data']
+
+
+def pipeline_stages():
+    """Source stage plus a build stage of which the action is mapped"""
+    return [
+        {'name': 'Source', 'actions': [{'name': 'Source'}]},
+        {'name': 'Build', 'actions': [{'name': 'Placeholder'}]}
+    ]
+
+
+def pipeline_properties():
+    return {
+        'Target': 'harness-pipeline',
+        'ExecutePipeline': 'true',
+        'Stages': [{
+            'StageOrder': '1',
+            'StageDeclaration': {
+                'Name': 'Build',
+                'Actions': [{
+                    'Name': 'Build',
+                    'ActionTypeId': {
+                        'Category': 'Build', 'Owner': 'AWS',
+                        'Provider': 'CodeBuild', 'Version': '1'
+                    },
+                    'RunOrder': '1',
+                    'Configuration': {
+                        'ProjectName': 'harness',
+                        'EnvironmentVariables': [
+                            {'Name': 'STAGE', 'Value': 'dev', 'Type': 'PLAINTEXT'}
+                        ]
+                    },
+                    'InputArtifacts': [{'Name': 'Source'}],
+                    'OutputArtifacts': [{'Name': 'Image'}]
+                }]
+            },
+            'MapConfig': [{
+                'SourceAction': 'Build',
+                'EnvironmentVariables': {'IMAGE': 'api,web,worker'},
+                'NameList': 'api,web,worker'
+            }]
+        }]
+    }
+
+
+def scenario_ssm_param_put(harness):
+    properties = {'Parameters': {'/harness/a': '1', '/harness/b': '2'}}
+    event = harness.event('Create', properties, module=ssm_param_put)
+    harness.invoke(ssm_param_put, event)
+    expect_status(harness, event)
+    expect(harness.ssm.parameters == properties['Parameters'], 'parameters not created')
+
+    update = {'Parameters': {'/harness/a': '1', '/harness/c': '3'}}
+    event = harness.event(
+        'Update', update, module=ssm_param_put, old_properties=properties)
+    harness.invoke(ssm_param_put, event)
+    data = expect_status(harness, event)
+    expect(data['ParametersWritten'] == '/harness/c', f'unexpected writes: {data}')
+    expect(harness.ssm.parameters == update['Parameters'], 'parameters not reconciled')
+
+    event = harness.event('Delete', update, module=ssm_param_put)
+    harness.invoke(ssm_param_put, event)
+    expect_status(harness, event)
+    expect(not harness.ssm.parameters, 'parameters not deleted')
+
+
+def scenario_ecr_create(harness):
+    properties = {'EnvironmentName': 'Dev', 'RepositoryPathList': 'api,web'}
+    event = harness.event('Create', properties, module=ecr_create)
+    harness.invoke(ecr_create, event)
+    expect_status(harness, event)
+    expect(harness.ecr.repositories == {'dev/api', 'dev/web'}, 'repositories not created')
+
+    update = {'EnvironmentName': 'Dev', 'RepositoryPathList': 'web,worker'}
+    event = harness.event('Update', update, module=ecr_create, old_properties=properties)
+    harness.invoke(ecr_create, event)
+    expect_status(harness, event)
+    expect(harness.ecr.repositories == {'dev/web', 'dev/worker'}, 'repositories not reconciled')
+
+    event = harness.event('Delete', update, module=ecr_create)
+    harness.invoke(ecr_create, event)
+    expect_status(harness, event)
+    expect(not harness.ecr.repositories, 'repositories not deleted')
+
+
+def scenario_pipeline_update(harness):
+    harness.codepipeline.add('harness-pipeline', pipeline_stages())
+    properties = pipeline_properties()
+    event = harness.event('Create', properties, module=pipeline_update)
+    harness.invoke(pipeline_update, event)
+    data = expect_status(harness, event)
+    actions = harness.codepipeline.pipelines['harness-pipeline']['stages'][1]['actions']
+    expect([action['name'] for action in actions] == ['api', 'web', 'worker'],
+           'mapped actions missing')
+    expect(data['PipelineExecutionId'], 'pipeline not executed')
+
+    event = harness.event(
+        'Update', properties, module=pipeline_update, old_properties=properties)
+    harness.invoke(pipeline_update, event)
+    data = expect_status(harness, event)
+    expect(data['PipelineChanged'] == 0, 'unchanged pipeline was updated')
+    expect(not data['PipelineExecutionId'], 'unchanged pipeline was executed')
+
+    event = harness.event('Delete', properties, module=pipeline_update)
+    harness.invoke(pipeline_update, event)
+    expect_status(harness, event)
+
+    # without global EnvironmentVariables only the mapped ones are set
+    actions = pipeline_update.mapper(
+        {'name': 'Build', 'configuration': {'ProjectName': 'harness'}},
+        {'Build': {'EnvironmentVariables': {'A': '1'}, 'NameList': 'api'}})
+    variables = actions[0]['configuration']['EnvironmentVariables']
+    expect(json.loads(variables) == [{'name': 'A', 'value': '1', 'type': 'PLAINTEXT'}],
+           f'EnvironmentVariables: {variables}')
+
+
+def scenario_waiter_check_pipeline(harness, multiplex=False):
+    harness.codepipeline.add('harness-pipeline', pipeline_stages())
+    execution_id = harness.codepipeline.start_pipeline_execution(
+        name='harness-pipeline')['pipelineExecutionId']
+    properties = {
+        'TimeoutInMinutes': '20',
+        'Multiplex': str(multiplex).lower(),
+        'Probes': [{
+            'Provider': 'Lambda',
+            'Properties': {
+                'ServiceToken': FUNCTIONS[check_pipeline],
+                'PipelineName': 'harness-pipeline',
+                'PipelineExecutionId': execution_id
+            }
+        }]
+    }
+    event = harness.event('Create', properties, module=eventrule_waiter, logical_id='Waiter')
+    harness.invoke(eventrule_waiter, event)
+    response, ticks = harness.until_response(event)
+    expect(response is not None, f'no response after {ticks} ticks')
+    expect(response['Status'] == 'SUCCESS', f"waiter: {response['Status']} {response['Data']}")
+    if multiplex:
+        # the shared eventrule is disabled on the first tick without waits
+        harness.tick()
+    expect(not harness.events.scheduled(), 'eventrule left enabled')
+
+    # e.g. a late probe result, written after the wait completed
+    harness.s3.put(eventrule_waiter.waiter_bucket(),
+                   eventrule_waiter.waiter_key('harness-Waiter', 'lambda-probe-0'), b'{}')
+    event = harness.event('Delete', properties, module=eventrule_waiter, logical_id='Waiter')
+    harness.invoke(eventrule_waiter, event)
+    expect_status(harness, event)
+    left = [key for key in harness.s3.buckets[eventrule_waiter.waiter_bucket()]
+            if '-Waiter/' in key]
+    expect(not left, f'objects left after Delete: {left}')
+
+
+def scenario_waiter_multiplex(harness):
+    scenario_waiter_check_pipeline(harness, multiplex=True)
+
+
+def scenario_waiter_native_probes(harness):
+    harness.server.health_status = 503
+    properties = {
+        'TimeoutInMinutes': '20',
+        'Probes': [
+            {'Provider': 'Http', 'Properties': {'Url': harness.server.health_url()}},
+            {'Provider': 'Tcp', 'Properties': {
+                'Host': '127.0.0.1', 'Port': str(harness.server.port)}}
+        ]
+    }
+    event = harness.event('Create', properties, module=eventrule_waiter, logical_id='Waiter')
+    harness.invoke(eventrule_waiter, event)
+    expect(harness.response(event) is None, 'unhealthy target passed')
+
+    harness.server.health_status = 200
+    response, ticks = harness.until_response(event)
+    expect(response is not None and response['Status'] == 'SUCCESS', 'healthy target not passed')
+    expect(not harness.recorder.calls[('lambda', 'Invoke')], 'native probes invoked Lambda')
+
+    # a port that accepts connections, but does not (yet) serve HTTP
+    listener = socket.create_server(('127.0.0.1', 0))
+
+    def not_http():
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            with conn:
+                conn.sendall(b'starting\r\n\r\n')
+
+    threading.Thread(target=not_http, daemon=True).start()
+    properties['Probes'] = [{'Provider': 'Http', 'Properties': {
+        'Url': f'http://127.0.0.1:{listener.getsockname()[1]}/'}}]
+    event = harness.event('Create', properties, module=eventrule_waiter, logical_id='Starting')
+    try:
+        harness.invoke(eventrule_waiter, event)
+        expect(harness.response(event) is None, 'target not serving HTTP ended the wait')
+    finally:
+        listener.close()
+
+    # invalid probes fail on Create, not on every tick
+    properties['Probes'] = [{'Provider': 'Http', 'Properties': {'Url': 'localhost/health'}}]
+    event = harness.event('Create', properties, module=eventrule_waiter, logical_id='Invalid')
+    harness.invoke(eventrule_waiter, event)
+    data = expect_status(harness, event, status='FAILED')
+    expect('Http probe' in data.get('Message', ''), f'message: {data}')
+
+
+def scenario_waiter_ecs_probes(harness):
+    names = [f'service-{idx}' for idx in range(25)]
+    for name in names:
+        harness.ecs.add('harness', name, desired=2, running=1, rollout='IN_PROGRESS')
+    properties = {
+        'TimeoutInMinutes': '20',
+        'Probes': [
+            {'Provider': 'Ecs', 'Properties': {'Cluster': 'harness', 'Services': names[:20]}},
+            {'Provider': 'Ecs', 'Properties': {
+                'Cluster': 'harness', 'Services': ','.join(names[15:])}},
+            # cluster still being created: pending, not FAILED
+            {'Provider': 'Ecs', 'Properties': {'Cluster': 'starting', 'Services': 'web'}}
+        ]
+    }
+    event = harness.event('Create', properties, module=eventrule_waiter, logical_id='Waiter')
+    harness.invoke(eventrule_waiter, event)
+    expect(harness.response(event) is None, 'services passed while rolling out')
+    expect(harness.recorder.calls[('ecs', 'DescribeServices')] == 4,
+           f"describe_services calls: {harness.recorder.calls[('ecs', 'DescribeServices')]}")
+
+    for name in names:
+        harness.ecs.add('harness', name, desired=2, running=2)
+    harness.tick()
+    expect(harness.response(event) is None, 'passed while the cluster does not exist')
+    harness.ecs.add('starting', 'web')
+    response, ticks = harness.until_response(event)
+    expect(response is not None and response['Status'] == 'SUCCESS', 'stable services not passed')
+
+    # probes without services fail on Create, not by timeout
+    for services in [None, '', ' , ', []]:
+        probe = {'Cluster': 'harness'}
+        if services is not None:
+            probe['Services'] = services
+        properties['Probes'] = [{'Provider': 'Ecs', 'Properties': probe}]
+        event = harness.event('Create', properties, module=eventrule_waiter, logical_id='Invalid')
+        harness.invoke(eventrule_waiter, event)
+        data = expect_status(harness, event, status='FAILED')
+        expect('Ecs probe' in data.get('Message', ''), f'message: {data}')
+
+
+def scenario_waiter_many_probes(harness):
+    """Hundreds of probes: the wait is stored in the bucket, the eventrule
+    target Input only carries a reference (well below the 8 KB limit)"""
+    names = [f'service-{idx}' for idx in range(300)]
+    for name in names:
+        harness.ecs.add('harness', name, desired=2, running=1, rollout='IN_PROGRESS')
+    properties = {
+        'TimeoutInMinutes': '20',
+        'Probes': [
+            {'Provider': 'Ecs', 'Properties': {'Cluster': 'harness', 'Services': name}}
+            for name in names
+        ]
+    }
+    event = harness.event('Create', properties, module=eventrule_waiter, logical_id='Waiter')
+    expect(len(json.dumps(properties)) > 8192, 'probes fit the target Input anyway')
+    harness.invoke(eventrule_waiter, event)
+    expect(harness.response(event) is None, 'services passed while rolling out')
+    inputs = [json.dumps(target_input) for _, target_input in harness.events.scheduled()]
+    expect(len(inputs) == 1 and len(inputs[0]) < 512, f'target Input: {inputs}')
+
+    # unchanged wait is not fetched again in a warm container, once in a cold one
+    harness.recorder.reset()
+    harness.tick()
+    expect(not harness.recorder.calls[('s3', 'GetObject')], 'warm tick fetched the wait')
+    eventrule_waiter._fetch_cache.clear()
+    harness.tick()
+    expect(harness.recorder.calls[('s3', 'GetObject')] == 1, 'cold tick did not fetch the wait')
+
+    for name in names:
+        harness.ecs.add('harness', name, desired=2, running=2)
+    response, ticks = harness.until_response(event)
+    expect(response is not None and response['Status'] == 'SUCCESS', 'stable services not passed')
+    expect(not [key for key in harness.s3.buckets[eventrule_waiter.waiter_bucket()] if key.endswith('/input.json')],
+           'wait left in the bucket')
+
+
+def scenario_waiter_lost_record(harness):
+    """The eventrule of a wait is deleted once its record is removed, or
+    replaced without the rule target being updated"""
+    harness.server.health_status = 503
+    properties = {
+        'TimeoutInMinutes': '20',
+        'Probes': [{'Provider': 'Http', 'Properties': {'Url': harness.server.health_url()}}]
+    }
+    bucket = harness.s3.buckets[eventrule_waiter.waiter_bucket()]
+    for change in ['remove', 'replace']:
+        event = harness.event(
+            'Create', properties, module=eventrule_waiter, logical_id=f'Waiter{change}')
+        harness.invoke(eventrule_waiter, event)
+        key = [key for key in bucket if key.endswith(f'Waiter{change}/input.json')][0]
+        # a tick scheduled before an Update carries an outdated reference
+        function_arn, reference = harness.events.scheduled()[0]
+        harness.lambda_.run(function_arn, dict(reference, ETag='"outdated"'))
+        expect(harness.events.scheduled(), 'eventrule removed on an outdated reference')
+        if change == 'remove':
+            harness.s3.delete_object(Bucket=eventrule_waiter.waiter_bucket(), Key=key)
+        else:
+            harness.s3.put(eventrule_waiter.waiter_bucket(), key, b'{}')
+        eventrule_waiter._fetch_cache.clear()
+        harness.tick()
+        expect(not harness.events.scheduled(), f'eventrule left after record {change}')
+
+
+def scenario_waiter_probe_states(harness):
+    """Settled (SUCCESS) and in-flight (no answer yet) Lambda probes are not
+    invoked again, probes answering IN_PROGRESS are invoked on every tick"""
+    invocations = {}
+
+    # invokes of the 'slow' probe outlive ProbeTimeoutInSeconds
+    slow_invokes = []
+    lambda_invoke = harness.lambda_.invoke
+
+    def invoke(FunctionName, **kwargs):
+        if FunctionName.endswith('-slow'):
+            slow_invokes.append(time.time())
+            time.sleep(0.5)
+        return lambda_invoke(FunctionName=FunctionName, **kwargs)
+
+    harness.lambda_.invoke = invoke
+
+    def probe(name, answers):
+        # answers: status sent on the n-th invocation (last one repeats),
+        # None sends nothing -- the probe stays in flight
+        invocations[name] = []
+
+        def handler(event, context):
+            invocations[name].append(event)
+            answer = answers[min(len(invocations[name]), len(answers)) - 1]
+            if answer:
+                cfn_response.send_status(event, context, answer, {})
+
+        function_arn = f'{FUNCTIONS[eventrule_waiter]}-{name}'
+        harness.lambda_.add(function_arn, handler)
+        return {'Provider': 'Lambda', 'Properties': {'ServiceToken': function_arn}}
+
+    properties = {
+        'TimeoutInMinutes': '20',
+        'ProbeTimeoutInSeconds': '0.2',
+        'Probes': [
+            probe('settled', ['SUCCESS']),
+            probe('polling', ['IN_PROGRESS'] * 3 + ['SUCCESS']),
+            probe('silent', [None]),
+            probe('slow', ['SUCCESS'])
+        ]
+    }
+    event = harness.event('Create', properties, module=eventrule_waiter, logical_id='Waiter')
+    harness.invoke(eventrule_waiter, event)
+    for _ in range(5):
+        harness.tick()
+    counts = {name: len(events) for name, events in invocations.items() if name != 'slow'}
+    expect(counts == {'settled': 1, 'polling': 4, 'silent': 1}, f'invocations: {counts}')
+    expect(len(slow_invokes) == 1, f'slow probe invoked {len(slow_invokes)} times')
+    expect(harness.response(event) is None, 'passed while a probe is in flight')
+
+    # the slow invoke completes (and the probe answers) in the background
+    deadline = time.time() + 5
+    while not invocations['slow'] and time.time() < deadline:
+        time.sleep(0.05)
+    harness.lambda_.drain()
+
+    # a late answer of the in-flight probe completes the wait
+    cfn_response.send_status(invocations['silent'][0], None, 'SUCCESS', {})
+    response, ticks = harness.until_response(event)
+    expect(response is not None and response['Status'] == 'SUCCESS', 'late answer not passed')
+    expect(len(invocations['silent']) == 1, 'in-flight probe invoked again')
+
+
+def scenario_waiter_s3_errors(harness):
+    """A failing listing or state.json write is retried on the next tick,
+    it does not end the wait"""
+    invocations = []
+
+    def handler(event, context):
+        invocations.append(event)
+        cfn_response.send_status(event, context, 'IN_PROGRESS', {})
+
+    function_arn = f'{FUNCTIONS[eventrule_waiter]}-throttled'
+    harness.lambda_.add(function_arn, handler)
+    properties = {
+        'TimeoutInMinutes': '20',
+        'Probes': [{'Provider': 'Lambda', 'Properties': {'ServiceToken': function_arn}}]
+    }
+    event = harness.event('Create', properties, module=eventrule_waiter, logical_id='Waiter')
+    harness.invoke(eventrule_waiter, event)
+    harness.tick()
+
+    s3_list, s3_put = harness.s3.list_objects_v2, harness.s3.put_object
+
+    def list_objects_v2(**kwargs):
+        raise ClientError('SlowDown: Please reduce your request rate')
+
+    def put_object(Key, **kwargs):
+        if Key.endswith('/state.json'):
+            raise ClientError('InternalError: We encountered an internal error')
+        return s3_put(Key=Key, **kwargs)
+
+    for name, stub in [('list_objects_v2', list_objects_v2), ('put_object', put_object)]:
+        setattr(harness.s3, name, stub)
+        count = len(invocations)
+        harness.tick()
+        setattr(harness.s3, name, {'list_objects_v2': s3_list, 'put_object': s3_put}[name])
+        expect(harness.response(event) is None, f'{name} error ended the wait')
+        expect(harness.events.scheduled(), f'eventrule removed on a {name} error')
+        if name == 'put_object':
+            expect(len(invocations) == count + 1, 'probe not invoked without state.json')
+
+    # the probe passes once answering SUCCESS
+    harness.lambda_.add(function_arn, lambda event, context: cfn_response.send_status(
+        event, context, 'SUCCESS', {}))
+    response, ticks = harness.until_response(event)
+    expect(response is not None and response['Status'] == 'SUCCESS', 'wait not passed')
+
+
+def scenario_check_pipeline(harness):
+    harness.codepipeline.add('harness-pipeline', pipeline_stages())
+    execution_id = harness.codepipeline.start_pipeline_execution(
+        name='harness-pipeline')['pipelineExecutionId']
+    key = 'harness/check/lambda-probe-0'
+    event = {
+        'RequestType': 'StatusUpdate',
+        'RequestId': 'check',
+        'ResourceProperties': {
+            'PipelineName': 'harness-pipeline', 'PipelineExecutionId': execution_id
+        },
+        'ResponseUrlData': {
+            'Url': 'https://harness-waiter-bucket.s3.eu-west-1.amazonaws.com/',
+            'FormData': {'key': key, 'bucket': 'harness-waiter-bucket'}
+        }
+    }
+    statuses = []
+    for _ in range(3):
+        harness.invoke(check_pipeline, event)
+        result = json.loads(harness.s3.buckets['harness-waiter-bucket'][key])
+        statuses.append(result['ResponseStatus'])
+    expect(statuses[0] == 'IN_PROGRESS' and statuses[-1] == 'SUCCESS', f'statuses: {statuses}')
+
+    # event driven: a state-change eventrule is registered while in progress,
+    # and removed when the tracked execution is superseded ...
+    execution_id = harness.codepipeline.start_pipeline_execution(
+        name='harness-pipeline')['pipelineExecutionId']
+    event['ResourceProperties'].update(PipelineExecutionId=execution_id, EventDriven='true')
+    harness.invoke(check_pipeline, event)
+    expect('harness-pipeline-waiter' in harness.events.rules, 'push eventrule not registered')
+    harness.invoke(check_pipeline, dict(
+        event, RequestType='PipelineStateChange', State='SUPERSEDED', ExecutionId=execution_id))
+    expect('harness-pipeline-waiter' not in harness.events.rules, 'push eventrule left')
+
+    # ... or cancelled, which is pushed as FAILED ...
+    check_pipeline._push_registered.clear()
+    harness.invoke(check_pipeline, event)
+    harness.invoke(check_pipeline, dict(
+        event, RequestType='PipelineStateChange', State='CANCELED', ExecutionId=execution_id))
+    result = json.loads(harness.s3.buckets['harness-waiter-bucket'][key])
+    expect(result['ResponseStatus'] == 'FAILED', f'cancelled: {result}')
+    expect('harness-pipeline-waiter' not in harness.events.rules, 'push eventrule left on cancel')
+
+    # ... or by the CheckPipelineRule resource on stack delete
+    check_pipeline._push_registered.clear()
+    harness.invoke(check_pipeline, event)
+    delete_event = harness.event(
+        'Delete', {'PipelineName': 'harness-pipeline'}, module=check_pipeline)
+    harness.invoke(check_pipeline, delete_event)
+    expect_status(harness, delete_event)
+    expect('harness-pipeline-waiter' not in harness.events.rules, 'push eventrule left on Delete')
+
+
+def scenario_empty_bucket(harness):
+    for idx in range(2500):
+        harness.s3.put('harness-data', f'prefix-{idx % 3}/object-{idx}', b'x')
+    properties = {'BucketName': 'harness-data'}
+    event = harness.event('Create', properties, module=empty_bucket)
+    harness.invoke(empty_bucket, event)
+    expect_status(harness, event)
+
+    event = harness.event('Delete', properties, module=empty_bucket)
+    harness.invoke(empty_bucket, event)
+    data = expect_status(harness, event)
+    expect(data['Deleted'] == 2500, f'deleted: {data}')
+    expect(not harness.s3.buckets['harness-data'], 'bucket not empty')
+
+    # flat bucket: an estimate and a sharding page, then listed as one shard
+    for idx in range(2500):
+        harness.s3.put('harness-data', f'object-{idx}', b'x')
+    harness.recorder.reset()
+    event = harness.event('Delete', properties, module=empty_bucket)
+    harness.invoke(empty_bucket, event)
+    data = expect_status(harness, event)
+    listings = harness.recorder.calls[('s3', 'ListObjectVersions')]
+    expect(data['Deleted'] == 2500 and listings == 5, f'deleted: {data}, listings: {listings}')
+
+
+def scenario_empty_bucket_lifecycle(harness):
+    for idx in range(1500):
+        harness.s3.put('harness-data', f'object-{idx}', b'x')
+    properties = {'BucketName': 'harness-data', 'LifecycleThreshold': '1000'}
+    event = harness.event(
+        'Delete', properties, module=empty_bucket, logical_id='EmptyBucket',
+        physical_id='EmptyBucket')
+    harness.invoke(empty_bucket, event)
+    expect('harness-data' in harness.s3.lifecycle, 'lifecycle not configured')
+    # expiry is a backstop, the bucket is emptied by deletes within this request
+    data = expect_status(harness, event)
+    expect(data['Deleted'] == 1500, f'deleted: {data}')
+    expect(not harness.s3.buckets['harness-data'], 'bucket not empty')
+
+    # the estimate follows the current state, not an older (larger) datapoint
+    harness.s3.lifecycle.clear()
+    for idx in range(1200):
+        harness.s3.put('harness-data', f'object-{idx}', b'x')
+    properties['LifecycleThreshold'] = '2000'
+    event = harness.event('Delete', properties, module=empty_bucket)
+    harness.invoke(empty_bucket, event)
+    expect_status(harness, event)
+    expect('harness-data' not in harness.s3.lifecycle, 'lifecycle on an older estimate')
+
+    # no metrics: empty by direct deletes only, do not fail the stack delete
+    for idx in range(1500):
+        harness.s3.put('harness-data', f'object-{idx}', b'x')
+    harness.cloudwatch.denied = True
+    properties['LifecycleThreshold'] = '1000'
+    event = harness.event('Delete', properties, module=empty_bucket)
+    harness.invoke(empty_bucket, event)
+    data = expect_status(harness, event)
+    expect(data['Deleted'] == 1500, f'deleted without metrics: {data}')
+    expect('harness-data' not in harness.s3.lifecycle, 'lifecycle without an estimate')
+
+
+def scenario_shared_modules(harness):
+    for module in SHARED_MODULES:
+        contents = set()
+        for path in SOURCE_DIRS:
+            with open(os.path.join(path, module), 'rb') as f:
+                contents.add(f.read())
+        expect(len(contents) == 1, f'{module} differs between WaiterLambda/src and ContainerBuild/src')
+
+
+SCENARIOS = [
+    scenario_shared_modules,
+    scenario_ssm_param_put,
+    scenario_ecr_create,
+    scenario_pipeline_update,
+    scenario_check_pipeline,
+    scenario_waiter_check_pipeline,
+    scenario_waiter_multiplex,
+    scenario_waiter_native_probes,
+    scenario_waiter_ecs_probes,
+    scenario_waiter_many_probes,
+    scenario_waiter_lost_record,
+    scenario_waiter_probe_states,
+    scenario_waiter_s3_errors,
+    scenario_empty_bucket,
+    scenario_empty_bucket_lifecycle
+]
+
+
+def main():
+    failures = 0
+    for scenario in SCENARIOS:
+        name = scenario.__name__.replace('scenario_', '')
+        start_time = time.time()
+        try:
+            with Harness() as harness:
+                scenario(harness)
+                calls = harness.recorder.total()
+            print(f'OK      {name} ({calls} API calls, {time.time() - start_time:.2f}s)')
+        except ScenarioError as e:
+            failures += 1
+            print(f'FAILED  {name}: {str(e)}')
+        except Exception:
+            failures += 1
+            print(f'ERROR   {name}')
+            traceback.print_exc()
+    return failures
+
+
+if __name__ == '__main__':
+    sys.exit(1 if main() else 0)